@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+# This program archives many threads at once. It takes a file of thread URLs,
+# one per line, each optionally followed by the name of its archive. The page
+# fetches of all the threads are shared between a pool of worker threads. Each
+# domain takes its turn, so a slow forum only holds up its own threads. Each
+# page is spooled to disk as soon as it has been got, so a run which is killed
+# carries on where it stopped when started again. Once all of a thread's pages
+# are in, the thread is written with store_thread. A thread which has been
+# archived before is brought up to date as update_thread would, from the last
+# page stored.
+
+import forum_archive, os, re, sys, json, time, threading, collections, argparse, shutil, traceback
+import urllib.parse
+
+def archive_name(url):
+    """Returns a file name for the archive of the thread at url."""
+    u = urllib.parse.urlsplit(url)
+    s = re.sub(r"[^A-Za-z0-9.-]+", "_", u.netloc + u.path + ('_' + u.query if u.query else ''))
+    return s.strip('_.')[:150] + '.json.gz'
+
+class Spool:
+    """The pages of one thread got so far, kept in a directory: state.json
+    holds the URL, the page count and the first page wanted, and each page's
+    posts are in a file of their own.
+
+    """
+    def __init__(self, dirname):
+        self.dir = dirname
+        os.makedirs(dirname, exist_ok=True)
+    def state(self):
+        try:
+            with open(os.path.join(self.dir, 'state.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    def set_state(self, **kw):
+        forum_archive.write_json(os.path.join(self.dir, 'state.json'), kw)
+    def fname(self, page):
+        return os.path.join(self.dir, 'page-{}.json'.format(page))
+    def has(self, page):
+        return os.path.exists(self.fname(page))
+    def put(self, page, posts):
+        forum_archive.write_json(self.fname(page), [dict(p) for p in posts])
+    def get(self, page):
+        with open(self.fname(page)) as f:
+            return [forum_archive.Post(**p) for p in json.load(f)]
+    def remove(self):
+        shutil.rmtree(self.dir)
+
+class Scheduler:
+    """Runs tasks on a pool of worker threads. Each task belongs to a domain; the
+    domains take turns, and no more than per_domain tasks from one domain run at
+    once, so that workers are never all kept waiting on one forum. Tasks may
+    add more tasks. run returns once there are none left; the exceptions of
+    tasks which failed are passed to the task's onerror, if it has one, and
+    otherwise printed.
+
+    """
+    def __init__(self, workers, per_domain):
+        self.workers, self.per_domain = workers, per_domain
+        self.cv = threading.Condition()
+        self.queues = collections.OrderedDict()
+        self.running = collections.Counter()
+        self.pending = 0
+    def add(self, domain, func, *args, onerror=None):
+        with self.cv:
+            self.queues.setdefault(domain, collections.deque()).append((func, args, onerror))
+            self.pending += 1
+            self.cv.notify()
+    def next(self):
+        for d, q in self.queues.items():
+            if q and self.running[d] < self.per_domain:
+                self.queues.move_to_end(d)
+                self.running[d] += 1
+                return d, q.popleft()
+        return None
+    def worker(self):
+        while True:
+            with self.cv:
+                t = self.next()
+                while t is None:
+                    if not self.pending:
+                        return
+                    self.cv.wait()
+                    t = self.next()
+            d, (func, args, onerror) = t
+            try:
+                func(*args)
+            except Exception as e:
+                if onerror is None:
+                    traceback.print_exc()
+                else:
+                    onerror(e)
+            finally:
+                with self.cv:
+                    self.running[d] -= 1
+                    self.pending -= 1
+                    self.cv.notify_all()
+    def run(self):
+        ts = [threading.Thread(target=self.worker, daemon=True) for i in range(self.workers)]
+        for i in ts:
+            i.start()
+        for i in ts:
+            while i.is_alive():
+                i.join(1) # so that an interrupt is seen
+
+class Job:
+    """One thread being archived."""
+    def __init__(self, url, fname, spool):
+        self.url, self.fname, self.spool = url, fname, spool
+        self.domain = urllib.parse.urlsplit(url).netloc
+        self.getter = None
+        self.started = time.perf_counter()
+        self.remaining = 0
+        self.failed = False
+        self.lock = threading.Lock()
+
+class BatchArchiver:
+    """Archives a list of threads, given as (url, archive file name) pairs, with
+    spools kept under spooldir. cred maps domains to the credentials given
+    to their getters; each domain's getters share them, and so log in once.
+    Domains without credentials share a cookie jar. Pages are parsed on the
+    worker threads which fetch them or, if processes is given, on a pool of
+    that many processes, while the other workers carry on fetching.
+
+    """
+    def __init__(self, threads, spooldir, workers=8, cred={}, processes=0):
+        self.jobs = [Job(url, fname, Spool(os.path.join(spooldir, os.path.basename(fname))))
+                     for url, fname in threads]
+        self.sched = Scheduler(workers, forum_archive.domain_limit)
+        self.cred = forum_archive.domain_credentials(cred)
+        self.login_locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+        self.done = self.failed = 0
+        self.processes = processes
+        self.pool = None
+    def run(self):
+        """Archives every thread. Returns the number which failed."""
+        for j in self.jobs:
+            self.sched.add(j.domain, self.start, j, onerror=lambda e, j=j: self.fail(j, e))
+        if self.processes:
+            self.pool = forum_archive.parse_pool(self.processes)
+        try:
+            self.sched.run()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+        return self.failed
+    def start(self, j):
+        with self.login_locks[j.domain]:
+            j.getter = forum_archive.make_getter(j.url, self.cred[j.domain])
+        st = j.spool.state()
+        if st is None or st['url'] != j.url:
+            try:
+                old = forum_archive.load_thread(j.fname)[1]
+            except FileNotFoundError:
+                old = None
+            soup = j.getter.get_page(j.getter.url, j.getter.npages_only)
+            npages = j.getter.npages = j.getter.get_npages(soup)
+            del soup
+            forum_archive.emit('npages', url=j.getter.url, npages=npages)
+            st = {'url': j.url, 'npages': npages, 'first': old or 1, 'merge': old is not None}
+            j.spool.set_state(**st)
+        j.npages, j.pages = st['npages'], range(st['first'], st['npages'] + 1)
+        j.merge = st['merge']
+        todo = [p for p in j.pages if not j.spool.has(p)]
+        j.remaining = len(todo)
+        if not todo:
+            self.finish(j)
+        for p in todo:
+            self.sched.add(j.domain, self.page, j, p, onerror=lambda e, j=j: self.fail(j, e))
+    def page(self, j, p):
+        if j.failed:
+            return
+        url = j.getter.make_page_url(p)
+        if self.pool is None:
+            posts, times = j.getter.timed_page_posts(url)
+        else:
+            t = time.perf_counter()
+            html = j.getter.fetch_page(url)
+            t = time.perf_counter() - t
+            posts, times = self.pool.submit(j.getter.page_posts, html, url).result()
+            times['fetch'] = t
+        forum_archive.emit('page', url=j.getter.url, page=p, npages=j.npages, posts=len(posts), **times)
+        j.spool.put(p, posts)
+        with j.lock:
+            j.remaining -= 1
+            last = not j.remaining and not j.failed
+        if last:
+            self.finish(j)
+    def finish(self, j):
+        posts = (p for pg in j.pages for p in j.spool.get(pg))
+        if j.merge:
+            posts = forum_archive.merge_posts(forum_archive.load_thread(j.fname)[0], posts)
+        n = 0
+        def count(posts):
+            nonlocal n
+            for p in posts:
+                n += 1
+                yield p
+        forum_archive.store_thread(count(posts), j.fname, j.npages)
+        j.spool.remove()
+        forum_archive.emit('thread', url=j.getter.url, pages=len(j.pages), posts=n, time=time.perf_counter() - j.started)
+        with self.lock:
+            self.done += 1
+            print("[{}/{}] {}: {} posts, {} pages".format(self.done + self.failed, len(self.jobs), j.url, n, j.npages))
+    def fail(self, j, e):
+        with j.lock:
+            if j.failed:
+                return
+            j.failed = True
+        with self.lock:
+            self.failed += 1
+            print("[{}/{}] {}: failed: {!r}".format(self.done + self.failed, len(self.jobs), j.url, e), file=sys.stderr)
+
+def read_list(fname, outdir):
+    """Reads a thread list, returning (url, archive file name) pairs. Blank lines
+    and those starting with # are skipped."""
+    rv, seen = [], set()
+    with open(fname) as f:
+        for l in f:
+            l = l.split()
+            if not l or l[0].startswith('#'):
+                continue
+            fn = os.path.join(outdir, l[1] if len(l) > 1 else archive_name(l[0]))
+            if fn not in seen:
+                seen.add(fn)
+                rv.append((l[0], fn))
+    return rv
+
+def main():
+    ap = argparse.ArgumentParser(description="Archive many forum threads")
+    ap.add_argument("list", help="File of thread URLs, one per line, each optionally followed by an archive name")
+    ap.add_argument("-o", "--output", help="Directory for archives", default=".")
+    ap.add_argument("-w", "--workers", type=int, help="Number of pages to download at once", default=8)
+    ap.add_argument("-P", "--parse-processes", type=int, help="Number of processes parsing downloaded pages", default=0)
+    ap.add_argument("-c", "--credential", action="append", default=[],
+                    help="Log in to a domain, given as domain=username:password; may be repeated")
+    ap.add_argument("--timezone", action="append", default=[],
+                    help="Timezone of a forum's dates, given as host=zone, e.g. forums.spacebattles.com=America/New_York; may be repeated")
+    ap.add_argument("--sessions", help="Directory keeping logged-in sessions between runs",
+                    default=forum_archive.cache_path('forum_archive_sessions'))
+    ap.add_argument("--cache", help="Keep downloaded pages in this cache file", default=None)
+    ap.add_argument("--metrics", help="Write a JSON summary of requests, pages and timings to this file", default=None)
+    args = ap.parse_args()
+    cred = forum_archive.parse_credentials(args.credential)
+    os.makedirs(args.output, exist_ok=True)
+    forum_archive.sessions = forum_archive.SessionStore(args.sessions)
+    forum_archive.parse_timezones(args.timezone)
+    if args.cache:
+        forum_archive.cache = forum_archive.HTTPCache(args.cache)
+    # Page-by-page progress from many threads at once is just noise.
+    forum_archive.sinks[:] = [i for i in forum_archive.sinks if not isinstance(i, forum_archive.Progress)]
+    if args.metrics:
+        metrics = forum_archive.Collector()
+        forum_archive.sinks.append(metrics)
+    b = BatchArchiver(read_list(args.list, args.output), os.path.join(args.output, '.spool'), args.workers, cred, args.parse_processes)
+    try:
+        failed = b.run()
+    finally:
+        if args.metrics:
+            metrics.dump(args.metrics)
+    sys.exit(1 if failed else 0)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+
+# Offline benchmarks for forum_archive and thread_story. Pages recorded from
+# each supported forum engine are kept in bench/fixtures, with placeholders for
+# the page number, page count and IDs; a local HTTP server fills these in and
+# serves them with a configurable delay, standing in both for the XenForo forum
+# (at its own address) and, acting as an HTTP proxy, for the forums whose hosts
+# are fixed in their getters. No network access is needed.
+#
+# For each getter, get_thread is run over the whole thread, and
+# thread_story.download_story over a set of chapters on the XenForo thread,
+# reporting pages and posts per second, kilobytes received, the time spent in
+# each phase (fetching, parsing, get_posts and process_html, summed over all
+# worker threads and parsing processes) and the peak memory allocated in this
+# process, measured in a second run under tracemalloc.
+
+import os, sys, re, time, json, argparse, threading, http.server, http.cookiejar
+import urllib.parse, tracemalloc, collections, gzip
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import forum_archive, thread_story
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TID, FID = 4321, 87
+
+def load_fixtures():
+    rv = {}
+    for i in ['xf', 'qq', 'bl', 'ffn']:
+        with open(os.path.join(FIXTURES, i + '.html'), encoding='utf-8') as f:
+            rv[i] = f.read()
+    return rv
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the fixtures. The server's fixtures, npages and latency attributes
+    say what to serve and how slowly; if its gzip attribute is set, pages are
+    compressed for clients which accept that."""
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 2**16 # send headers and body together
+    def log_message(self, *args):
+        pass
+    def fill(self, forum, page, **kw):
+        s = self.server
+        t = s.fixtures[forum].replace('@PAGE@', str(page)).replace('@NPAGES@', str(s.npages))
+        t = t.replace('@TID@', str(TID)).replace('@FID@', str(FID)).replace('@HOST@', self.host)
+        for k, v in kw.items():
+            t = t.replace('@{}@'.format(k.upper()), v)
+        return 200, t.encode()
+    def route(self):
+        u = urllib.parse.urlsplit(self.path)
+        host = u.netloc or self.headers.get('Host', '')
+        self.host = host
+        n = self.server.npages
+        if host == 'questionablequesting.com':
+            o = re.match(r"topic=\d+\.(\d+)", u.query)
+            if not o:
+                return 404, b''
+            page = int(o.group(1)) // 50 + 1
+            links = []
+            for i in sorted(set([1, 2, 3, page, n])):
+                if 1 <= i <= n:
+                    links.append("[<strong>{}</strong>]".format(i) if i == page else
+                                 '<a class="navPages" href="http://questionablequesting.com/index.php?topic={}.{}">{}</a>'.format(TID, (i - 1) * 50, i))
+            return self.fill('qq', page, offset=str((page - 1) * 50), pagelinks=' '.join(links))
+        if host == 'forums.nrvnqsr.com':
+            o = re.match(r"/showthread\.php/\d+[^/]*(/page(\d+))?$", u.path)
+            if not o:
+                return 404, b''
+            return self.fill('bl', int(o.group(2) or 1))
+        if host == 'www.fanfiction.net':
+            o = re.match(r"/topic/\d+/\d+/?((\d+)/?)?$", u.path)
+            if not o:
+                return 404, b''
+            page = int(o.group(2) or 1)
+            if page > n:
+                return 302, '/topic/{}/{}/'.format(FID, TID)
+            links = ['<a href="/topic/{}/{}/{}/">{}</a>'.format(FID, TID, i, i) for i in range(1, min(page + 2, n) + 1)]
+            return self.fill('ffn', page, pagelinks=' '.join(links))
+        o = re.match(r"/posts/(\d+)/?$", u.path)
+        if o:
+            pid = int(o.group(1))
+            return 302, 'http://{}/threads/the-tower-on-the-hill.{}/page-{}#post-{}'.format(host, TID, pid // 100, pid)
+        o = re.match(r"/threads/([^/]*\.)?\d+/(page-(\d+))?$", u.path)
+        if o:
+            return self.fill('xf', int(o.group(3) or 1))
+        return 404, b''
+    def respond(self, body):
+        time.sleep(self.server.latency)
+        code, data = self.route()
+        self.send_response(code)
+        if code in (301, 302):
+            self.send_header('Location', data)
+            data = b''
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        if data and self.server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, 6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+    def do_GET(self):
+        self.respond(True)
+    def do_HEAD(self):
+        self.respond(False)
+
+def start_server(npages, latency, gzip=True):
+    s = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    s.daemon_threads = True
+    s.fixtures, s.npages, s.latency, s.gzip = load_fixtures(), npages, latency, gzip
+    threading.Thread(target=s.serve_forever, daemon=True).start()
+    return s
+
+class Phases:
+    """Accumulates the time spent in each phase, over all threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.t = collections.Counter()
+        self.n = collections.Counter()
+    def add(self, phase, dt):
+        with self.lock:
+            self.t[phase] += dt
+            self.n[phase] += 1
+    def wrap(self, phase, f):
+        def timed(*args, **kw):
+            t = time.perf_counter()
+            try:
+                return f(*args, **kw)
+            finally:
+                self.add(phase, time.perf_counter() - t)
+        return timed
+
+def reset():
+    """Clears everything remembered between runs, so that each does the same work."""
+    forum_archive.cache = None
+    forum_archive.redirect_memo = {}
+    forum_archive.FFNGetter.found_npages.clear()
+    forum_archive._rate_limiters.clear()
+    forum_archive.default_pool.close()
+
+def make_getters(port):
+    base = "http://127.0.0.1:{}".format(port)
+    return {
+        'xf': lambda: forum_archive.make_getter("{}/threads/the-tower-on-the-hill.{}/".format(base, TID)),
+        'qq': lambda: forum_archive.QQGetter("http://questionablequesting.com/index.php?topic={}.0".format(TID),
+                                             {'cookies': http.cookiejar.CookieJar()}),
+        'bl': lambda: forum_archive.BLGetter("http://forums.nrvnqsr.com/showthread.php/{}-The-Tower-on-the-Hill".format(TID)),
+        'ffn': lambda: forum_archive.FFNGetter("http://www.fanfiction.net/topic/{}/{}/".format(FID, TID)),
+    }
+
+def chapters(port, npages):
+    """Chapter list for download_story: one post per page, every third given as
+    a /posts/ link which has to be resolved."""
+    base = "http://127.0.0.1:{}".format(port)
+    rv = []
+    for p in range(1, npages + 1):
+        pid = p * 100 + 2
+        if p % 3:
+            rv.append(("Chapter {}".format(p), "{}/threads/the-tower-on-the-hill.{}/page-{}#post-{}".format(base, TID, p, pid)))
+        else:
+            rv.append(("Chapter {}".format(p), "{}/posts/{}/".format(base, pid)))
+    return rv
+
+def run(fn, phases):
+    """Runs fn with fetching and parsing timed, and the bytes received counted
+    in phases.bytes. Pages parsed in other processes are timed there, and their
+    times taken from the page events. Returns (result, wall time)."""
+    saved = forum_archive.urlopen_retry, forum_archive.make_soup
+    forum_archive.urlopen_retry = phases.wrap('fetch', forum_archive.urlopen_retry)
+    forum_archive.make_soup = phases.wrap('parse', forum_archive.make_soup)
+    c = forum_archive.Collector()
+    forum_archive.sinks.append(c)
+    try:
+        t = time.perf_counter()
+        rv = fn()
+        return rv, time.perf_counter() - t
+    finally:
+        forum_archive.urlopen_retry, forum_archive.make_soup = saved
+        forum_archive.sinks.remove(c)
+        phases.bytes = c.requests['bytes']
+        if forum_archive.ThreadGetter.parse_processes:
+            for i in ('parse', 'get_posts', 'process_html'):
+                phases.t[i] += c.totals[i]
+            phases.t['get_posts'] += c.totals['process_html']
+            phases.n['get_posts'] += c.totals['pages']
+
+def time_getter(g, phases):
+    """Times get_posts and process_html on the getter; get_posts is reported
+    without the process_html time inside it. Getters parsing in other processes
+    are left alone, as the wrappers can't be sent there."""
+    if forum_archive.ThreadGetter.parse_processes:
+        return g
+    ph = phases.wrap('process_html', g.process_html)
+    g.process_html = ph
+    g.get_posts = phases.wrap('get_posts', g.get_posts)
+    return g
+
+def bench_thread(name, mk, workers):
+    def once(phases):
+        reset()
+        g = time_getter(mk(), phases)
+        return g.get_thread(max_workers=workers)
+    phases = Phases()
+    thread, wall = run(lambda: once(phases), phases)
+    reset()
+    tracemalloc.start()
+    once(Phases())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result(name + ' get_thread', phases.n['get_posts'], len(thread), wall, phases, peak)
+
+def bench_story(port, npages, workers):
+    ch = chapters(port, npages)
+    forum_archive.ThreadGetter.max_workers = workers
+    def once(phases):
+        reset()
+        mk = forum_archive.make_getter
+        def timed_getter(*args, **kw):
+            return time_getter(mk(*args, **kw), phases)
+        thread_story.forum_archive.make_getter = timed_getter
+        try:
+            return thread_story.download_story(ch)
+        finally:
+            thread_story.forum_archive.make_getter = mk
+    phases = Phases()
+    story, wall = run(lambda: once(phases), phases)
+    reset()
+    tracemalloc.start()
+    once(Phases())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    forum_archive.ThreadGetter.max_workers = 1
+    return result('xf download_story', phases.n['get_posts'], len(story), wall, phases, peak)
+
+def result(name, pages, posts, wall, phases, peak):
+    t = dict(phases.t)
+    t['get_posts'] = t.get('get_posts', 0) - t.get('process_html', 0)
+    return {'name': name, 'pages': pages, 'posts': posts, 'wall': wall,
+            'pages_per_sec': pages / wall, 'posts_per_sec': posts / wall,
+            'phases': t, 'kib': phases.bytes / 2**10, 'peak_mib': peak / 2**20}
+
+def report(results, out):
+    cols = ['fetch', 'parse', 'get_posts', 'process_html']
+    out.write("{:<22} {:>6} {:>6} {:>8} {:>8} {:>9} {:>9} ".format('benchmark', 'pages', 'posts', 'wall s', 'pages/s', 'posts/s', 'KiB'))
+    out.write(" ".join("{:>12}".format(c) for c in cols) + " {:>9}\n".format('peak MiB'))
+    for r in results:
+        out.write("{name:<22} {pages:>6} {posts:>6} {wall:>8.3f} {pages_per_sec:>8.1f} {posts_per_sec:>9.1f} {kib:>9.1f} ".format(**r))
+        out.write(" ".join("{:>12.3f}".format(r['phases'].get(c, 0)) for c in cols) + " {:>9.2f}\n".format(r['peak_mib']))
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline forum_archive benchmarks")
+    ap.add_argument("-n", "--pages", type=int, default=30, help="Pages in each thread")
+    ap.add_argument("-l", "--latency", type=float, default=0.0, help="Seconds the server waits before each response")
+    ap.add_argument("-j", "--workers", type=int, default=1, help="max_workers for get_thread")
+    ap.add_argument("-P", "--parse-processes", type=int, default=0, help="Number of processes parsing pages")
+    ap.add_argument("-f", "--forums", default="xf,qq,bl,ffn", help="Comma-separated getters to run")
+    ap.add_argument("--parser", default=None, help="BeautifulSoup parser to use, e.g. html5lib")
+    ap.add_argument("--no-story", action="store_true", default=False, help="Skip the download_story benchmark")
+    ap.add_argument("--rate-limit", action="store_true", default=False,
+                    help="Pace requests with forum_archive's adaptive rate limiting, off by default")
+    ap.add_argument("--no-gzip", action="store_true", default=False, help="Serve pages uncompressed")
+    ap.add_argument("--json", default=None, help="Also write results to this file as JSON")
+    args = ap.parse_args()
+    if args.parser:
+        forum_archive.parser = args.parser
+    forum_archive.ThreadGetter.parse_processes = args.parse_processes
+    if not args.rate_limit:
+        rl = forum_archive.RateLimiter
+        rl.start_rate = rl.max_rate = rl.burst = 1e9
+    s = start_server(args.pages, args.latency, not args.no_gzip)
+    port = s.server_address[1]
+    # Everything goes through the server: it is also the proxy for fixed hosts.
+    os.environ['http_proxy'] = "http://127.0.0.1:{}".format(port)
+    os.environ.pop('no_proxy', None)
+    forum_archive.registry['127.0.0.1:{}'.format(port)] = 'forum_getters.xenforo:XFGetter'
+    getters = make_getters(port)
+    results = []
+    out = sys.stdout
+    sys.stdout = open(os.devnull, 'w') # progress output
+    try:
+        for i in args.forums.split(','):
+            results.append(bench_thread(i, getters[i], args.workers))
+        if not args.no_story:
+            results.append(bench_story(port, args.pages, args.workers))
+    finally:
+        sys.stdout.close()
+        sys.stdout = out
+        s.shutdown()
+    report(results, sys.stdout)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+
+if __name__=="__main__":
+    main()
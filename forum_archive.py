@@ -3,68 +3,1074 @@
 # This program is designed to scrape forum threads off the Web and return their
 # contents in a minimal common format. The ideal is to be able to write a plugin
 # for any forum and access it using the same API. A thread is returned as a list
-# of posts; a post is a dictionary providing HTML text, name of poster, date,
-# and other metadata as appropriate.
+# of posts; a post is a Post, which acts as a dictionary providing HTML text,
+# name of poster, date, and other metadata as appropriate.
 
 # This code has recently undergone a major rewrite in conjunction with the
 # thread_story script. The only thread modules which can be assumed to hold full
 # functionality along with that script are XFGetter and QQGetter.
 
-import re, urllib.request, urllib.error, urllib.parse, sys, datetime, http.client
-from bs4 import BeautifulSoup
-import bs4
-import dateutil.parser, datetime, math, time
-import traceback, http.cookiejar, hashlib
-import json, gzip
+# Only what every run needs is imported here. BeautifulSoup is imported when
+# the first page is parsed, the getter for each forum when the forum is first
+# seen (see registry), and the rest where they are used.
+import re, urllib.request, urllib.error, urllib.parse, sys, http.client, time, datetime, functools
+import json, threading, io, urllib.response, importlib, importlib.util
+import zlib, gzip, os, tempfile, collections, collections.abc, random
 
 # import http.client
 # http.client.HTTPConnection.debuglevel = 1
 
+# Maximum number of requests in flight to any one host at a time. This is shared
+# between all getters, so several threads from the same forum being downloaded
+# at once can't add up to more than this.
+domain_limit = 4
+_domain_slots = {}
+_domain_lock = threading.Lock()
+
+def domain_slot(url):
+    """Returns the semaphore which must be held while making a request to the
+    host of the given URL, creating it if necessary.
+
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    with _domain_lock:
+        s = _domain_slots.get(host)
+        if s is None:
+            s = _domain_slots[host] = threading.BoundedSemaphore(domain_limit)
+    return s
+
+class RateLimiter:
+    """Paces the requests made to one host, with a token bucket refilled at rate
+    tokens per second and holding at most burst. The rate adapts to how the
+    host copes: it creeps up by increase with each quick success, and is cut by
+    decrease when a response is much slower than usual (slow times the moving
+    average, and at least slow_floor seconds) or the host signals overload
+    (429 or a 5xx status, or a failed connection). An overloaded host can also
+    be left alone for a while with hold, as its Retry-After header asks.
+
+    """
+    start_rate = 4.0
+    min_rate = 0.2
+    max_rate = 50.0
+    burst = 4
+    increase = 0.5
+    decrease = 0.5
+    slow = 3.0
+    slow_floor = 0.5
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rate = self.start_rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.until = 0
+        self.latency = None
+    def acquire(self):
+        """Waits until a request may be made, and takes a token for it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now > self.stamp:
+                    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+                wait = self.until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+    def success(self, latency):
+        """Records a request answered in latency seconds."""
+        with self.lock:
+            if self.latency is not None and latency > max(self.slow * self.latency, self.slow_floor):
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+    def overloaded(self):
+        """Records a request the host refused or failed because of load."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+    def hold(self, seconds):
+        """Makes no more requests for the given number of seconds."""
+        with self.lock:
+            until = time.monotonic() + seconds
+            if until > self.until:
+                self.until = self.stamp = until
+                self.tokens = 0
+
+_rate_limiters = {}
+
+def domain_rate(url):
+    """Returns the RateLimiter for the host of the given URL, creating it if
+    necessary."""
+    host = urllib.parse.urlsplit(url).netloc
+    with _domain_lock:
+        r = _rate_limiters.get(host)
+        if r is None:
+            r = _rate_limiters[host] = RateLimiter()
+    return r
+
+def retry_after(headers):
+    """Returns the number of seconds a Retry-After header asks to wait, or None
+    if there is none."""
+    v = headers.get('Retry-After') if headers is not None else None
+    if not v:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(v).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def overload_status(status):
+    return status == 429 or status >= 500
+
+# Instrumentation. Every sink in this list is called as sink(event, data) for
+# each event, from whichever thread it happened on. The events are:
+#   request   a page fetched by urlopen_retry: url, status, bytes (of body
+#             received, so 0 if served from the cache), retries,
+#             cached (False, 'hit' or 'revalidated'), time, and error if failed
+#   redirect  a URL resolved by get_redirect: url, final_url, cached, time, and
+#             error if failed
+#   npages    the page count of a thread was found: url, npages
+#   page      a page of a thread was got: url, page, npages, posts, and the
+#             time spent in each phase (fetch, parse, get_posts, process_html)
+#   thread    a thread was got: url, pages, posts, time
+# Times are wall-clock seconds; get_posts time excludes process_html.
+sinks = []
+
+def emit(event, **data):
+    for s in sinks:
+        s(event, data)
+
+class Progress:
+    """A sink printing the number of pages in each thread and each page as it
+    is got, as getters have always done, and the URLs which couldn't be
+    fetched."""
+    def __init__(self, out=None):
+        self.out = out
+    def __call__(self, event, data):
+        out = self.out or sys.stdout
+        if event == 'npages':
+            print("{} pages".format(data['npages']), file=out)
+        elif event == 'page':
+            out.write("Got page {} of {}\n".format(data['page'], data['npages'] or '?'))
+        elif event == 'thread':
+            out.write('\n')
+        elif event in ('request', 'redirect') and 'error' in data:
+            print(data['url'], file=out)
+
+class Collector:
+    """A sink keeping totals for a run: requests by status, bytes, retries, cache
+    use and time, and the pages, posts and time in each phase, per thread as
+    well as overall. summary() returns them as a dict; dump() writes that to a
+    file as JSON. With keep_events, every event is kept in the events list too.
+
+    """
+    phases = ('fetch', 'parse', 'get_posts', 'process_html')
+    def __init__(self, keep_events=False):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.events = [] if keep_events else None
+        self.requests = collections.Counter()
+        self.status = collections.Counter()
+        self.threads = {}
+        self.totals = self.new_totals()
+    def new_totals(self):
+        return dict(pages=0, posts=0, **dict((i, 0.0) for i in self.phases))
+    def __call__(self, event, data):
+        with self.lock:
+            if self.events is not None:
+                self.events.append(dict(data, event=event, at=time.time() - self.start))
+            if event in ('request', 'redirect'):
+                r = self.requests
+                r[event + 's'] += 1
+                r['time'] += data['time']
+                r['bytes'] += data.get('bytes', 0)
+                r['retries'] += data.get('retries', 0)
+                r['errors'] += 'error' in data
+                if data.get('cached'):
+                    r['cached_' + data['cached']] += 1
+                if 'status' in data:
+                    self.status[str(data['status'])] += 1
+            elif event == 'npages':
+                self.thread(data['url'])['npages'] = data['npages']
+            elif event == 'page':
+                for t in (self.totals, self.thread(data['url'])):
+                    t['pages'] += 1
+                    t['posts'] += data['posts']
+                    for i in self.phases:
+                        t[i] += data[i]
+            elif event == 'thread':
+                self.thread(data['url'])['time'] = data['time']
+    def thread(self, url):
+        t = self.threads.get(url)
+        if t is None:
+            t = self.threads[url] = dict(self.new_totals(), npages=None, time=None)
+        return t
+    def summary(self):
+        with self.lock:
+            rv = {'started': self.start, 'wall': time.time() - self.start,
+                  'requests': dict(self.requests), 'status': dict(self.status),
+                  'totals': dict(self.totals), 'threads': dict((k, dict(v)) for k, v in self.threads.items())}
+            if self.events is not None:
+                rv['events'] = list(self.events)
+        return rv
+    def dump(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+sinks.append(Progress())
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections for reuse, keyed by scheme and host.
+    A connection is only ever lent to one request at a time, so a pool may be
+    shared between threads and between openers; hits, misses and reconnects
+    are counted so that reuse can be checked.
+
+    """
+    def __init__(self, maxidle=8):
+        self.maxidle = maxidle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.reconnects = 0
+    def get(self, key):
+        """Returns an idle connection for key, or None if there isn't one."""
+        with self.lock:
+            l = self.idle.get(key)
+            if l:
+                self.hits += 1
+                return l.pop()
+            self.misses += 1
+            return None
+    def put(self, key, conn):
+        with self.lock:
+            l = self.idle.setdefault(key, [])
+            if len(l) < self.maxidle:
+                l.append(conn)
+                return
+        conn.close()
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'reconnects': self.reconnects,
+                    'idle': sum(len(l) for l in self.idle.values())}
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for l in idle.values():
+            for c in l:
+                c.close()
+
+# Shared by every opener from make_opener unless given another.
+default_pool = ConnectionPool()
+
+class KeepAliveHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+    """A urllib handler for both HTTP and HTTPS which takes its connections from a
+    ConnectionPool and returns them afterwards, instead of opening a new one
+    for every request as urllib does. The response body is read in full before
+    the connection is given back; a pooled connection which the server has
+    since closed is replaced once, transparently.
+
+    """
+    def __init__(self, pool=None, context=None):
+        urllib.request.HTTPSHandler.__init__(self, context=context)
+        self.pool = default_pool if pool is None else pool
+    def http_open(self, req):
+        return self.pooled_open(req, http.client.HTTPConnection)
+    def https_open(self, req):
+        return self.pooled_open(req, http.client.HTTPSConnection, context=self._context)
+    def pooled_open(self, req, cls, **kw):
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers = dict((k.title(), v) for k, v in headers.items())
+        key = (cls.__name__, host, req._tunnel_host)
+        for attempt in range(2):
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if not reused:
+                conn = cls(host, timeout=req.timeout, **kw)
+                if req._tunnel_host:
+                    th = {}
+                    if 'Proxy-Authorization' in headers:
+                        th['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+                    conn.set_tunnel(req._tunnel_host, headers=th)
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers,
+                             encode_chunked=req.has_header('Transfer-encoding'))
+                r = conn.getresponse()
+                body = r.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused and attempt == 0: # went stale while idle
+                    with self.pool.lock:
+                        self.pool.reconnects += 1
+                    continue
+                raise urllib.error.URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+            break
+        if r.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+        resp = urllib.response.addinfourl(io.BytesIO(body), r.msg, req.get_full_url(), r.status)
+        resp.msg = r.reason
+        return resp
+
+class RateLimitHandler(urllib.request.BaseHandler):
+    """Sends every request through the RateLimiter of its host, and tells the
+    limiter how quickly it was answered and whether the host was overloaded,
+    holding off for as long as a Retry-After header asks."""
+    handler_order = 900 # before HTTPErrorProcessor turns errors into exceptions
+    def http_request(self, req):
+        domain_rate(req.full_url).acquire()
+        req.sent = time.monotonic()
+        return req
+    def http_response(self, req, r):
+        l = domain_rate(req.full_url)
+        if overload_status(r.status):
+            l.overloaded()
+            wait = retry_after(r.headers)
+            if wait:
+                l.hold(wait)
+        elif r.status < 400:
+            l.success(time.monotonic() - req.sent)
+        return r
+    https_request = http_request
+    https_response = http_response
+
+# Brotli is used if either of its bindings is installed.
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+def decoder(coding):
+    """Returns an object with decompress and flush methods decoding the given
+    Content-Encoding, or None if it isn't supported."""
+    if coding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if coding == 'deflate':
+        return DeflateDecoder()
+    if coding == 'br' and brotli is not None:
+        return BrotliDecoder()
+    return None
+
+class DeflateDecoder:
+    """Decodes deflate encoding, which servers send both with and without the
+    zlib header it should have."""
+    def __init__(self):
+        self.d = None
+    def decompress(self, data):
+        if self.d is None:
+            self.d = zlib.decompressobj()
+            try:
+                return self.d.decompress(data)
+            except zlib.error:
+                self.d = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.d.decompress(data)
+    def flush(self):
+        return self.d.flush() if self.d is not None else b''
+    @property
+    def eof(self):
+        return self.d is not None and self.d.eof
+
+class BrotliDecoder:
+    def __init__(self):
+        self.d = brotli.Decompressor()
+    def decompress(self, data):
+        return self.d.process(data) if hasattr(self.d, 'process') else self.d.decompress(data)
+    def flush(self):
+        return b''
+    @property
+    def eof(self):
+        return self.d.is_finished()
+
+# What decoders raise on a corrupt body.
+decode_errors = (zlib.error,) if brotli is None else (zlib.error, brotli.error)
+
+class DecompressHandler(urllib.request.BaseHandler):
+    """Asks for compressed responses, gzip, deflate and, if available, brotli,
+    and decodes them a chunk at a time into a buffer the response is then read
+    from, so that they look to the rest of urllib like any other. The decoded
+    response's wire_bytes attribute is the number of bytes actually received.
+    A corrupt or truncated body raises URLError, as a failed connection
+    would, so that urlopen_retry tries again."""
+    handler_order = 950 # so the response is decoded before anything looks at it
+    encodings = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+    chunk = 2**16
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-Encoding', self.encodings)
+        return req
+    def http_response(self, req, r):
+        codings = [i.strip().lower() for i in r.headers.get('Content-Encoding', '').split(',') if i.strip()]
+        codings = [i for i in codings if i != 'identity']
+        ds = [decoder(i) for i in reversed(codings)]
+        if not ds or None in ds:
+            return r
+        out, n = io.BytesIO(), 0
+        try:
+            while True:
+                data = r.read(self.chunk)
+                if not data:
+                    break
+                n += len(data)
+                for d in ds:
+                    data = d.decompress(data)
+                out.write(data)
+            data = b''
+            for d in ds:
+                data = d.decompress(data) + d.flush()
+            # An empty body, as HEAD and 304 responses have, is left alone.
+            if n and not all(d.eof for d in ds):
+                raise zlib.error("truncated {} body".format(", ".join(codings)))
+        except decode_errors as e:
+            raise urllib.error.URLError(e)
+        finally:
+            r.close()
+        out.write(data)
+        h = r.headers
+        del h['Content-Encoding']
+        del h['Content-Length']
+        h['Content-Length'] = str(out.tell())
+        out.seek(0)
+        resp = urllib.response.addinfourl(out, h, r.geturl(), r.status)
+        resp.msg = getattr(r, 'msg', '')
+        resp.wire_bytes = n
+        return resp
+    https_request = http_request
+    https_response = http_response
+
+class HeadRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects of HEAD requests with HEAD requests, rather than the GET
+    urllib would send, so that resolving a redirect never downloads a page."""
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = urllib.request.HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+        if new is not None and req.get_method() == 'HEAD':
+            new.method = 'HEAD'
+        return new
+
+def make_opener(cj=None, pool=None):
+    """Builds a urllib opener which keeps connections alive through a
+    ConnectionPool (default_pool unless given), paces requests to each host
+    with its RateLimiter, asks for compressed responses, and keeps its cookies
+    in cj, a fresh CookieJar if not given. The jar and pool are available as
+    the opener's cookiejar and pool attributes.
+
+    """
+    if cj is None:
+        import http.cookiejar
+        cj = http.cookiejar.CookieJar()
+    h = KeepAliveHandler(pool)
+    o = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj), HeadRedirectHandler(),
+                                    RateLimitHandler(), DecompressHandler(), h)
+    o.cookiejar, o.pool = cj, h.pool
+    return o
+
+_default_opener = None
+_opener_lock = threading.Lock()
+
+def default_opener():
+    """Returns the opener used for requests which aren't given one."""
+    global _default_opener
+    with _opener_lock:
+        if _default_opener is None:
+            _default_opener = make_opener()
+    return _default_opener
+
+class HTTPCache:
+    """A persistent cache of page responses and HEAD redirect results, kept in an
+    SQLite database at path. Entries are keyed on URL. A stored page younger
+    than ttl seconds is used as is; an older one is revalidated with a
+    conditional request using its ETag and Last-Modified, and only downloaded
+    again if it has changed. Page bodies are stored compressed, and once their
+    total size passes max_size the least recently used are evicted. In offline
+    mode nothing is requested at all: whatever is stored is used regardless of
+    age, and anything else is an error.
+
+    """
+    def __init__(self, path, max_size=256 * 2**20, ttl=0, offline=False):
+        self.max_size, self.ttl, self.offline = max_size, ttl, offline
+        self.lock = threading.Lock()
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, final_url TEXT,
+                etag TEXT, modified TEXT, ctype TEXT, stored REAL, used REAL,
+                size INTEGER, body BLOB);
+            CREATE INDEX IF NOT EXISTS pages_used ON pages (used);
+            CREATE TABLE IF NOT EXISTS redirects (url TEXT PRIMARY KEY, final_url TEXT, stored REAL);
+        """)
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+    def fresh(self, stored):
+        return self.offline or time.time() - stored < self.ttl
+    def get(self, url):
+        """Returns the stored entry for url as a dict, or None."""
+        with self.lock:
+            r = self.db.execute("SELECT final_url, etag, modified, ctype, stored, body FROM pages WHERE url = ?",
+                                (url,)).fetchone()
+            if r is None:
+                return None
+            self.db.execute("UPDATE pages SET used = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+        return dict(zip(('final_url', 'etag', 'modified', 'ctype', 'stored', 'body'), r))
+    def put(self, url, r, body):
+        """Stores body as the response for url, given the response object r."""
+        h = r.info()
+        z = zlib.compress(body)
+        now = time.time()
+        with self.lock:
+            old = self.db.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self.size += len(z) - (old[0] if old else 0)
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (url, r.geturl(), h.get('ETag'), h.get('Last-Modified'), h.get('Content-Type'),
+                             now, now, len(z), z))
+            self.evict()
+            self.db.commit()
+    def touch(self, url):
+        """Marks the entry for url as just revalidated."""
+        with self.lock:
+            self.db.execute("UPDATE pages SET stored = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+    def evict(self):
+        # Must be called with the lock held.
+        while self.size > self.max_size:
+            rows = self.db.execute("SELECT url, size FROM pages ORDER BY used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for u, n in rows:
+                self.db.execute("DELETE FROM pages WHERE url = ?", (u,))
+                self.size -= n
+                if self.size <= self.max_size:
+                    break
+    def response(self, e):
+        """Makes a response object out of a stored entry."""
+        h = http.client.parse_headers(io.BytesIO("Content-Type: {}\r\n\r\n".format(e['ctype'] or 'text/html').encode()))
+        r = urllib.response.addinfourl(io.BytesIO(zlib.decompress(e['body'])), h, e['final_url'], 200)
+        r.cached = True
+        return r
+    def get_redirect(self, url):
+        """Returns the stored redirect target of url, if it's fresh, or None."""
+        with self.lock:
+            r = self.db.execute("SELECT final_url, stored FROM redirects WHERE url = ?", (url,)).fetchone()
+        if r is not None and self.fresh(r[1]):
+            return r[0]
+    def put_redirect(self, url, final_url):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)", (url, final_url, time.time()))
+            self.db.commit()
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# The HTTPCache used by urlopen_retry and get_redirect, if any.
+cache = None
+
+class SessionStore:
+    """The cookie jars of logged-in sessions, keyed by domain and username, so
+    that getters for the same account share one and only log in when it holds
+    no live session. If dirname is given, each jar is also kept in a file
+    there, readable only by its owner, so that sessions last between runs and
+    are shared between processes.
+
+    """
+    def __init__(self, dirname=None):
+        self.dir = dirname
+        self.jars = {}
+        self.lock = threading.Lock()
+        self.locks = collections.defaultdict(threading.Lock)
+    def fname(self, domain, username):
+        import hashlib
+        u = hashlib.sha1(username.encode()).hexdigest()[:16]
+        return os.path.join(self.dir, "{}-{}.lwp".format(re.sub(r"[^A-Za-z0-9.-]", "_", domain), u))
+    def account_lock(self, domain, username):
+        """Returns a lock to hold while logging in to the account, so that
+        getters made at once don't all do so."""
+        with self.lock:
+            return self.locks[domain, username]
+    def jar(self, domain, username):
+        """Returns the cookie jar for the account, loading it if necessary."""
+        import http.cookiejar
+        with self.lock:
+            j = self.jars.get((domain, username))
+            if j is None:
+                j = self.jars[domain, username] = http.cookiejar.LWPCookieJar()
+                if self.dir is not None:
+                    try:
+                        j.load(self.fname(domain, username), ignore_discard=True)
+                    except (FileNotFoundError, http.cookiejar.LoadError):
+                        pass
+            return j
+    def save(self, domain, username):
+        if self.dir is None:
+            return
+        os.makedirs(self.dir, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            self.jar(domain, username).save(tmp, ignore_discard=True)
+            os.replace(tmp, self.fname(domain, username))
+        except:
+            os.unlink(tmp)
+            raise
+    @staticmethod
+    def live(jar, domain, name=None):
+        """Whether jar holds an unexpired cookie for domain whose name matches
+        the regular expression name, or any such cookie if name is None. No
+        request is made; a session the server has ended early isn't noticed."""
+        domain = re.sub(r":\d+$", "", domain)
+        for c in jar:
+            d = c.domain.lstrip('.')
+            if (domain == d or domain.endswith('.' + d)) and not c.is_expired() and \
+               (name is None or re.match(name, c.name)):
+                return True
+        return False
+
+# Logged-in sessions, shared by all getters. Replace with a SessionStore with
+# a directory to keep them between runs.
+sessions = SessionStore()
+
+def parse_credentials(specs):
+    """Takes credentials as given on the command line, domain=username:password,
+    and returns a dictionary of domains to them, as domain_credentials takes."""
+    cred = {}
+    for i in specs:
+        d, c = i.split('=', 1)
+        u, p = c.split(':', 1)
+        cred[d] = {'username': u, 'password': p}
+    return cred
+
+def domain_credentials(cred={}):
+    """Takes a dictionary of domains to credentials, and returns one giving
+    those to pass to the getters for any domain, so that they log in once. The
+    getters for a domain without credentials share a cookie jar."""
+    import http.cookiejar
+    rv = collections.defaultdict(lambda: {'cookies': http.cookiejar.CookieJar()})
+    rv.update((k, dict(v)) for k, v in cred.items())
+    return rv
+
+def cache_path(name):
+    """Returns the path of name in the user's cache directory, where files kept
+    between runs go by default."""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), name)
+
+def write_json(fname, data, indent=None):
+    """Writes data to fname as JSON, atomically."""
+    d = os.path.dirname(os.path.abspath(fname))
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+        replace_file(tmp, fname)
+    except:
+        os.unlink(tmp)
+        raise
+
+class JSONDict(dict):
+    """A dictionary kept in a JSON file, read when it is made if the file
+    exists. Changes are written by save."""
+    indent = None
+    def __init__(self, fname):
+        dict.__init__(self)
+        self.fname = fname
+        try:
+            with open(fname) as f:
+                self.update(json.load(f))
+        except FileNotFoundError:
+            pass
+    def save(self):
+        write_json(self.fname, dict(self), self.indent)
+
+class RedirectMemo(JSONDict):
+    """A dictionary of URLs to the results of get_redirect on them, kept in a
+    JSON file so that it lasts between runs."""
+
+# Results of get_redirect, which are never looked up again once known. May be
+# replaced with a RedirectMemo to keep them between runs.
+redirect_memo = {}
+
 def get_redirect(url, opener=None):
     """Takes a URL, sends a HEAD request, returns the URL of final redirection.
     Necessary for determining the canonical post URL from one of multiple
     possible forms. Imitates Firefox user agent string, in order to ensure
-    access to sites.
+    access to sites. Results are kept in redirect_memo, and in the cache if
+    there is one.
 
     """
+    r = redirect_memo.get(url)
+    if r is not None:
+        return r
+    t = time.perf_counter()
+    if cache is not None:
+        r = cache.get_redirect(url)
+        if r is not None:
+            emit('redirect', url=url, final_url=r, cached='hit', time=time.perf_counter() - t)
+            return r
+        if cache.offline:
+            emit('redirect', url=url, cached=False, time=0.0, error='offline')
+            raise urllib.error.URLError("{} not cached in offline mode".format(url))
     if opener is None:
-        ofunc = urllib.request.urlopen
-    else:
-        ofunc = opener.open
+        opener = default_opener()
+    ofunc = opener.open
     ro = urllib.request.Request(url, method='HEAD') #, headers={"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:34.0) Gecko/20100101 Firefox/34.0"})
     try:
-        r = ofunc(ro)
-    except:
-        print(url)
+        with domain_slot(url):
+            r = ofunc(ro)
+    except Exception as err:
+        emit('redirect', url=url, cached=False, time=time.perf_counter() - t, error=repr(err),
+             **({'status': err.code} if isinstance(err, urllib.error.HTTPError) else {}))
         raise
+    if cache is not None:
+        cache.put_redirect(url, r.geturl())
+    redirect_memo[url] = r.geturl()
+    emit('redirect', url=url, final_url=r.geturl(), status=r.status, cached=False, time=time.perf_counter() - t)
     return r.geturl()
 
-def urlopen_retry(url, tries=3, delay=1, opener=None):
+# Longest wait between tries in urlopen_retry, in seconds.
+max_backoff = 60
+
+def backoff(i, delay):
+    """Returns how long to wait before try i + 2: delay doubled with each try,
+    up to max_backoff, of which a random half is left out so that threads which
+    failed together don't all try again at the same moment."""
+    b = min(max_backoff, delay * 2**i)
+    return b / 2 + random.uniform(0, b / 2)
+
+def urlopen_retry(url, tries=3, delay=1, opener=None, headers={}):
     """Open a URL, with retries on failure. Spoofs user agent to look like Firefox,
-    due to various sites attempting to prohibit automatic downloading."""
-    req = urllib.request.Request(url) #, headers={"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0) Gecko/20100101 Firefox/21.0"})
+    due to various sites attempting to prohibit automatic downloading. If there
+    is a cache, fresh pages are served from it and stale ones revalidated.
+
+    Only failures which may pass are retried: failed connections, timeouts,
+    429 (too many requests) and server errors. Waits between tries grow
+    exponentially from delay (see backoff), and are at least as long as a
+    Retry-After header asks. The pace of requests to each host is set by its
+    RateLimiter, through the opener.
+
+    Extra request headers may be given. If they make the request conditional
+    and the page hasn't changed, the 304 response is returned; the cache is
+    then left out, but for offline use, since its own validators would
+    replace the caller's.
+
+    """
+    req = urllib.request.Request(url, headers=headers) #, headers={"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0) Gecko/20100101 Firefox/21.0"})
+    t = time.perf_counter()
+    c = cache
+    if c is not None and not c.offline and any(k.lower() in ('if-none-match', 'if-modified-since') for k in headers):
+        c = None
+    e = c.get(url) if c is not None else None
+    if e is not None:
+        if c.fresh(e['stored']):
+            emit('request', url=url, status=200, bytes=0, retries=0, cached='hit', time=time.perf_counter() - t)
+            return c.response(e)
+        if e['etag']:
+            req.add_header('If-None-Match', e['etag'])
+        if e['modified']:
+            req.add_header('If-Modified-Since', e['modified'])
+    elif c is not None and c.offline:
+        emit('request', url=url, bytes=0, retries=0, cached=False, time=0.0, error='offline')
+        raise urllib.error.URLError("{} not cached in offline mode".format(url))
     if opener is None:
-        ofunc = urllib.request.urlopen
-    else:
-        ofunc = opener.open
+        opener = default_opener()
+    ofunc = opener.open
     for i in range(tries):
         try:
             r = ofunc(req)
-        except urllib.error.URLError as e:
+        except urllib.error.HTTPError as err:
+            if err.code == 304 and e is not None:
+                c.touch(url)
+                emit('request', url=url, status=304, bytes=0, retries=i, cached='revalidated', time=time.perf_counter() - t)
+                return c.response(e)
+            if err.code == 304:
+                emit('request', url=url, status=304, bytes=0, retries=i, cached=False, time=time.perf_counter() - t)
+                return err
+            if i == tries - 1 or not (err.code == 408 or overload_status(err.code)):
+                emit('request', url=url, status=err.code, bytes=0, retries=i, cached=False, time=time.perf_counter() - t, error=repr(err))
+                raise err
+            time.sleep(max(backoff(i, delay), retry_after(err.headers) or 0))
+        except urllib.error.URLError as err:
+            domain_rate(url).overloaded()
             if i == tries - 1:
-                raise e
-            time.sleep(delay)
+                emit('request', url=url, bytes=0, retries=i, cached=False, time=time.perf_counter() - t, error=repr(err))
+                raise err
+            time.sleep(backoff(i, delay))
         else:
-            return r
+            body = r.read()
+            if c is not None and r.status == 200:
+                c.put(url, r, body)
+            emit('request', url=url, status=r.status, bytes=getattr(r, 'wire_bytes', len(body)), retries=i,
+                 cached=False, time=time.perf_counter() - t)
+            return urllib.response.addinfourl(io.BytesIO(body), r.info(), r.geturl(), r.status)
+
+# The parser BeautifulSoup uses for every page. lxml is by far the fastest, and
+# unlike html5lib can build only the parts of a page a getter asks for. It is
+# only looked for here, and imported by BeautifulSoup when first used.
+parser = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+
+def make_soup(html, parse_only=None):
+    """Parses HTML with the configured parser. If parse_only is given, a
+    SoupStrainer, only the matching elements are built."""
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, parser, parse_only=parse_only)
+
+def has_class(name):
+    """Returns a matcher for the class_ argument of a SoupStrainer, which must
+    match the raw attribute value since it is used before that is split."""
+    return re.compile(r"(^|\s){}(\s|$)".format(re.escape(name)))
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(s, formats=(), tz=None):
+    """Parses a date string, returning it in ISO 8601 form with its timezone,
+    tz if the string doesn't give one; with neither, the date is left without
+    an offset rather than given a made-up one. Each of the strptime formats
+    given is tried first; dateutil's much slower guesswork is only used if
+    none match. Results are remembered, since many posts share a date string.
+
+    """
+    s = s.strip()
+    for f in formats:
+        try:
+            d = datetime.datetime.strptime(s, f)
+            break
+        except ValueError:
+            pass
+    else:
+        import dateutil.parser
+        d = dateutil.parser.parse(s)
+    if d.tzinfo is None and tz is not None:
+        d = d.replace(tzinfo=tz)
+    return d.isoformat()
+
+# Timezones of the dates forums show, by host, overriding those their getters
+# declare: the zone of the account logged in with, say, or a forum's own choice.
+timezones = {}
+
+def parse_timezones(specs):
+    """Takes timezones as given on the command line, host=zone with an IANA
+    zone name such as America/New_York, and adds them to timezones."""
+    import zoneinfo
+    for i in specs:
+        h, z = i.split('=', 1)
+        timezones[h.lower()] = zoneinfo.ZoneInfo(z)
+
+class Post(collections.abc.Mapping):
+    """A single post, as returned by getters. It can be used exactly like a
+    read-only dictionary with the keys poster_name, poster_url, post_url,
+    text, orig_text and date, but is much smaller: there is no per-post dict,
+    poster names and URLs are interned so that each is stored once however
+    many posts share it, and orig_text, rarely used, is kept compressed and
+    only decoded when asked for.
+
+    """
+    __slots__ = ('poster_name', 'poster_url', 'post_url', 'text', 'date', '_orig')
+    fields = ('poster_name', 'poster_url', 'post_url', 'text', 'orig_text', 'date')
+    def __init__(self, poster_name, poster_url, post_url, text, orig_text=None, date=""):
+        self.poster_name = poster_name if poster_name is None else sys.intern(str(poster_name))
+        self.poster_url = poster_url if poster_url is None else sys.intern(str(poster_url))
+        self.post_url = post_url
+        self.text = text
+        self.date = date
+        self._orig = None if orig_text is None else zlib.compress(orig_text.encode(), 1)
+    @property
+    def orig_text(self):
+        return None if self._orig is None else zlib.decompress(self._orig).decode()
+    def __getitem__(self, key):
+        if key in self.fields:
+            return getattr(self, key)
+        raise KeyError(key)
+    def __iter__(self):
+        return iter(self.fields)
+    def __len__(self):
+        return len(self.fields)
+    def __repr__(self):
+        return "Post({})".format(", ".join("{}={!r}".format(k, self[k]) for k in self.fields if k != 'orig_text'))
+    def __reduce__(self):
+        # Pickled as a compact record, orig_text still compressed, for posts
+        # sent back from the processes parsing pages.
+        return (_restore_post, (self.poster_name, self.poster_url, self.post_url, self.text, self.date, self._orig))
+
+def _restore_post(poster_name, poster_url, post_url, text, date, orig):
+    p = Post(poster_name, poster_url, post_url, text, None, date)
+    p._orig = orig
+    return p
+
+def ordered_map(func, items, max_workers):
+    """Applies func to each of items on a pool of max_workers threads, yielding the
+    results in the order of items. No more than twice max_workers results are
+    in progress or waiting to be consumed at any time.
+
+    """
+    if max_workers <= 1:
+        yield from map(func, items)
+        return
+    import concurrent.futures
+    ex = concurrent.futures.ThreadPoolExecutor(max_workers)
+    try:
+        q = collections.deque()
+        for i in items:
+            if len(q) >= 2 * max_workers:
+                yield q.popleft().result()
+            q.append(ex.submit(func, i))
+        while q:
+            yield q.popleft().result()
+    finally:
+        ex.shutdown(cancel_futures=True)
+
+def _set_parser(p):
+    global parser
+    parser = p
+
+def parse_pool(processes):
+    """Returns a process pool for parsing pages with ThreadGetter.page_posts.
+    Its processes use the parser configured here, whether or not they
+    inherit it."""
+    import concurrent.futures
+    return concurrent.futures.ProcessPoolExecutor(processes, initializer=_set_parser, initargs=(parser,))
+
+# Time spent in process_html by the current thread, for page_posts.
+_timing = threading.local()
 
 class ThreadGetter:
     """This is an abstract class that should be subclassed for each individual
     forum implemented."""
+    # Number of pages fetched at once by get_thread, unless overridden there.
+    max_workers = 1
+    # Number of processes parsing the pages fetched by get_thread, unless
+    # overridden there; 0 to parse each page on the thread that fetched it.
+    parse_processes = 0
+    # SoupStrainers selecting the parts of a page which get_posts and get_npages
+    # respectively look at; None to parse the whole page.
+    posts_only = npages_only = None
+    # Whether posts carry their HTML as it was on the page, as orig_text, as
+    # well as the processed text. Without it orig_text is None.
+    keep_orig = True
+    # Regular expression matching the name of the cookie which holds a
+    # logged-in session, for start_session; None if any cookie will do.
+    session_cookie = None
+    # The strptime formats of the dates the forum shows, and the timezone they
+    # are in to guests, for parse_date; timezones may give another. Where the
+    # timezone isn't known, None, dates are kept without an offset.
+    date_formats = ()
+    timezone = None
     def __init__(self, url, *args):
         self.url = url
         if not hasattr(self, 'opener'):
-            self.opener = None
-    def get_thread(self, pages=None):
+            self.opener = make_opener()
+    def __getstate__(self):
+        # Getters are pickled to be sent to the processes parsing pages, which
+        # need none of what is used to fetch them. keep_orig goes along in case
+        # it was set on the class, which those processes may not see.
+        d = dict(self.__dict__)
+        for i in ('opener', 'conn', 'cred'):
+            d.pop(i, None)
+        d['keep_orig'] = self.keep_orig
+        d['timezone'] = self.date_timezone()
+        return d
+    def start_session(self, domain, cred):
+        """Makes the getter's opener, returning its cookie jar. That is the
+        jar in cred['cookies'] if there is one. Otherwise, given a username and
+        password, it is the jar of the account in sessions, and login is only
+        called if that holds no live session; without either, a new jar.
+
+        """
+        cj = cred.get('cookies')
+        if cj is None and 'username' in cred and 'password' in cred:
+            u = cred['username']
+            with sessions.account_lock(domain, u):
+                cj = sessions.jar(domain, u)
+                self.opener = make_opener(cj)
+                if not sessions.live(cj, domain, self.session_cookie):
+                    self.login(**cred)
+                    sessions.save(domain, u)
+            return cj
+        if cj is None:
+            import http.cookiejar
+            cj = http.cookiejar.CookieJar()
+        self.opener = make_opener(cj)
+        return cj
+    def date_timezone(self):
+        """Returns the timezone of the dates the forum shows: the one given for
+        its host in timezones, or else the class's."""
+        return timezones.get(urllib.parse.urlsplit(self.url).netloc.lower(), self.timezone)
+    def parse_date(self, s):
+        """Returns the ISO 8601 form of a date string shown by the forum."""
+        return parse_date(s, self.date_formats, self.date_timezone())
+    def fetch_page(self, url):
+        """Downloads a page of the forum, returning its HTML as bytes. The
+        request counts against the per-domain limit."""
+        with domain_slot(url):
+            return urlopen_retry(url, opener=self.opener).read()
+    def get_page(self, url, parse_only=None):
+        """Fetches a page of the forum, returning its BeautifulSoup, limited to
+        parse_only if given. The request counts against the per-domain limit
+        while the page is downloaded, but not while it is parsed."""
+        return make_soup(self.fetch_page(url), parse_only)
+    def get_page_posts(self, url):
+        """Fetches a page of the thread and returns the list of posts on it."""
+        return self.get_posts(self.get_page(url, self.posts_only), url)
+    def page_posts(self, html, url):
+        """Parses the HTML of a page of the thread fetched from url, returning a
+        tuple (posts, times), times being a dict of the time spent in each
+        phase, as page events report. This needs no network access, and may be
+        run in another process; see parse_pool."""
+        _timing.process_html = 0.0
+        t0 = time.perf_counter()
+        soup = make_soup(html, self.posts_only)
+        t1 = time.perf_counter()
+        posts = self.get_posts(soup, url)
+        t2 = time.perf_counter()
+        ph = _timing.process_html
+        return posts, {'parse': t1 - t0, 'get_posts': t2 - t1 - ph, 'process_html': ph}
+    def timed_page_posts(self, url):
+        """As get_page_posts, but returns a tuple (posts, times) as page_posts
+        does, with the time spent fetching the page."""
+        t = time.perf_counter()
+        html = self.fetch_page(url)
+        t = time.perf_counter() - t
+        posts, times = self.page_posts(html, url)
+        return posts, dict(fetch=t, **times)
+    def pooled_page_posts(self, purls, max_workers, processes):
+        """Yields (posts, times), as timed_page_posts returns, for each of purls
+        in order. The pages are fetched on max_workers threads and parsed on a
+        pool of processes, so that parsing neither holds up fetching nor is
+        limited to one core. No more than twice as many pages as there are
+        processes wait to be parsed at any time, and fetching stops ahead of
+        them as ordered_map does.
+
+        """
+        def fetch(url):
+            t = time.perf_counter()
+            return url, self.fetch_page(url), time.perf_counter() - t
+        pool = parse_pool(processes)
+        q = collections.deque()
+        def result():
+            f, t = q.popleft()
+            posts, times = f.result()
+            return posts, dict(fetch=t, **times)
+        try:
+            for url, html, t in ordered_map(fetch, purls, max_workers):
+                if len(q) >= 2 * processes:
+                    yield result()
+                q.append((pool.submit(self.page_posts, html, url), t))
+            while q:
+                yield result()
+        finally:
+            pool.shutdown(cancel_futures=True)
+    def get_thread(self, pages=None, max_workers=None, processes=None):
         """This method will download the thread (of the appropriate forum) which was
         passed to the object's constructor. URLs are not checked for
         correctness; unpredictable errors will occur on one which is not as
@@ -75,13 +1081,37 @@ class ThreadGetter:
         provides, or an opaque string (page component) which will download the
         correct page when plugged into a URL.
 
+        If max_workers (or the getter's max_workers attribute) is greater than
+        one, that many pages are downloaded concurrently, subject to
+        domain_limit. Posts are returned in page order regardless. If processes
+        (or the parse_processes attribute) is given, pages are parsed on that
+        many processes while more are fetched; see pooled_page_posts.
+
+        The first page is only downloaded to count the pages if that's needed to
+        know which to get; the count is then kept as the npages attribute.
+
+        """
+        return list(self.iter_posts(pages, max_workers, processes))
+    def iter_pages(self, pages=None, max_workers=None, processes=None):
+        """A generator version of get_thread, taking the same arguments. Yields a
+        tuple (page, posts) for each page in order as soon as it has been
+        parsed, so that the thread need never be held in memory all at once.
+        When downloading concurrently, only a few pages are fetched ahead of the
+        one last yielded.
+
         """
-        r = urlopen_retry(self.url, opener=self.opener)
-        html = r.read()
-        soup = BeautifulSoup(html)
-        npages = self.get_npages(soup)
-        print("{} pages".format(npages))
-        thread = []
+        if max_workers is None:
+            max_workers = self.max_workers
+        if processes is None:
+            processes = self.parse_processes
+        t = time.perf_counter()
+        npages = None
+        # The page count is only needed if the pages to get depend on it.
+        if pages is None or type(pages) == tuple and not pages[1]:
+            soup = self.get_page(self.url, self.npages_only)
+            npages = self.npages = self.get_npages(soup)
+            del soup
+            emit('npages', url=self.url, npages=npages)
         if pages is None:
             pages = range(1, npages+1)
         if type(pages) == tuple:
@@ -90,15 +1120,21 @@ class ThreadGetter:
             pages = range(first, last+1)
         if type(pages) not in [list, range]:
             pages = [pages]
-        for i in pages:
-            purl = self.make_page_url(i)
-            r = urlopen_retry(purl, opener=self.opener)
-            html = r.read()
-            soup = BeautifulSoup(html)
-            thread = thread + self.get_posts(soup, purl)
-            sys.stdout.write("Got page {} of {}\n".format(i, npages))
-        sys.stdout.write('\n')
-        return thread
+        purls = [self.make_page_url(i) for i in pages]
+        n = 0
+        if processes:
+            results = self.pooled_page_posts(purls, max_workers, processes)
+        else:
+            results = ordered_map(self.timed_page_posts, purls, max_workers)
+        for i, (posts, times) in zip(pages, results):
+            emit('page', url=self.url, page=i, npages=npages, posts=len(posts), **times)
+            n += len(posts)
+            yield i, posts
+        emit('thread', url=self.url, pages=len(purls), posts=n, time=time.perf_counter() - t)
+    def iter_posts(self, pages=None, max_workers=None, processes=None):
+        """A generator version of get_thread, yielding posts one by one."""
+        for i, posts in self.iter_pages(pages, max_workers, processes):
+            yield from posts
     def get_posts(self, soup, url):
         """This method takes a BeautifulSoup of a forum page and extracts the
         list of posts from it, retaining the various data."""
@@ -120,11 +1156,21 @@ class ThreadGetter:
         """This method takes a page number, and constructs a page URL based on
         the original to fetch that page number."""
         pass
-    def process_html(self, text):
-        """This method takes the HTML text of a forum post and reconstructs it
-        to rid it of dependency on a site's CSS and javascript, allowing easy
-        static rendering."""
-        return text
+    def process_html(self, el):
+        """This method takes the element of a page's tree holding the text of a
+        forum post, and reconstructs it in place to rid it of dependency on a
+        site's CSS and javascript, allowing easy static rendering. Returns the
+        resulting HTML text. Subclasses may also be given a string of HTML."""
+        return str(el)
+    def render_post(self, el):
+        """Returns the pair (text, orig_text) for a post whose text is held in
+        the element el, processing it with process_html. The original is only
+        serialized if keep_orig is set, and before it is modified."""
+        orig = str(el) if self.keep_orig else None
+        t = time.perf_counter()
+        text = self.process_html(el)
+        _timing.process_html = getattr(_timing, 'process_html', 0.0) + time.perf_counter() - t
+        return text, orig
     def get_url_page(self, url):
         """This method takes a URL pointing to a thread page and returns the page number
         or page component. This is guaranteed to be valid when passed to
@@ -132,341 +1178,242 @@ class ThreadGetter:
 
         """
         
-class FFNGetter(ThreadGetter):
-    fid = tid = None
-    def get_posts(self, soup, url):
-        rv = []
-        for i in soup.find("table", id="gui_table2i").tbody("td"):
-            poster_name = str(i.a.string)
-            poster_url = "http://www.fanfiction.net" + i.a['href']
-            post_url = url + "#{}".format(i.a['id'])
-            text = ""
-            for p in i.a.next_siblings:
-                if isinstance(p, bs4.element.NavigableString):
-                    if p != " ":
-                        text += "<p>{}</p>\n".format(str(p).encode('utf-8').strip())
-                    continue
-                if p.name == "span":
-                    break
-                text += str(p) + "\n"
-            date = dateutil.parser.parse(i.find("span", class_="xdate")['title']).isoformat()
-            rv.append({'poster_name': poster_name, 'poster_url': poster_url, 'post_url': post_url, 'text': self.process_html(text), 'orig_text': text, 'date': date})
-        return rv
-    # FFn forums' rendering is so damned inconsistent and full of special cases
-    # it's really not worth trying to extract the number of pages from the
-    # thread page itself. Hence this, which is terrible but works.
-    def get_npages(self, soup):
-        n = 1
-        # Scan for a reasonable starting point, so we aren't going through every page in a 150-page thread.
-        pages = soup.find("center")
-        for i in pages("a"):
-            o = re.match(r"/topic/(\d+)/(\d+)/(\d+).*", i['href'])
-            if o is not None:
-                b = int(o.group(3))
-                if b > n:
-                    n = b
-        a = http.client.HTTPConnection("www.fanfiction.net")
-        while 1:
-            u = self.make_page_url(n)[25:] # get filepath part of URL
-            a.request("HEAD", u)
-            try:
-                b = a.getresponse()
-            except (http.client.BadStatusLine, http.client.ResponseNotReady): # connection was closed
-                a = http.client.HTTPConnection("www.fanfiction.net")
-                continue
-            if b.status == 200:
-                n += 1
-                continue
-            elif b.status == 302:
-                return n-1 # This is the response we get if the page is invalid
-            else:
-                raise Exception("Invalid status: {}".format(b.status))            
-    def make_page_url(self, page):
-        if self.fid == None or self.tid == None:
-            o = re.match("http://www.fanfiction.net/topic/(\d+)/(\d+).*", self.url)
-            self.fid = o.group(1)
-            self.tid = o.group(2)
-        return "http://www.fanfiction.net/topic/{}/{}/{}".format(self.fid, self.tid, page)
+# Getters by host name. Each is either a getter class or the name of one,
+# "module:Class", which is imported when a URL on the host is first seen. Hosts
+# not listed are looked up among the entry points in the group
+# "forum_archive.getters", each named for a host, and then matched against the
+# patterns in getters.
+registry = { 'forums.spacebattles.com': 'forum_getters.xenforo:XFGetter',
+             'forums.sufficientvelocity.com': 'forum_getters.xenforo:XFGetter',
+             'forums.nrvnqsr.com': 'forum_getters.vbulletin:BLGetter',
+             'forum.questionablequesting.com': 'forum_getters.xenforo:XFGetter', }
 
-class XFGetter(ThreadGetter):
-    """This class is designed to retrieve threads from XenForo forums, including
-    Spacebattles and Sufficient Velocity. The domain is inferred from the thread
-    URL.
+# (regular expression, getter class) pairs for URLs which can't be told apart
+# by host alone, tried in order on those whose host isn't in the registry.
+getters = []
 
-    """
-    def __init__(self, url, cred={}, *args):
-        o = re.match("((?P<scheme>https?)://)?(?P<domain>[^/]+)/", url)
-        self.domain = o.group('domain')
-        self.scheme = o.group('scheme')
-        cj = cred.get('cookies', http.cookiejar.CookieJar())
-        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj))
-        if not 'cookies' in cred and 'username' in cred and 'password' in cred:
-            self.login(**cred)
-        self.cred = cred
-        self.cred['cookies'] = cj
-        url = get_redirect(url, opener=self.opener)
-        ThreadGetter.__init__(self, url)
-        o = re.match(r"https?://[^/]+/threads/[^.]+\.(\d+).*", self.url)
-        self.tid = o.group(1)
-    def login(self, username, password, **args):
-        ue = urllib.parse.urlencode
-        req = urllib.request.Request('{}://{}/'.format(self.scheme, self.domain)) #, headers={"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0) Gecko/20100101 Firefox/21.0"})
-        self.opener.open(req)
-        req = urllib.request.Request('{}://{}/login/login'.format(self.scheme, self.domain)) #, headers={"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0) Gecko/20100101 Firefox/21.0"})
-        r = self.opener.open(req, data=ue({'login': username, 'password': password, 'redirect': '{}://{}/'.format(self.scheme, self.domain),
-                                           'register': '0', 'remember': '1', 'cookie_check': '1', '_xfToken': ''}).encode())
-        return r.read()
-#                         data="login={}&register=0&password={}&remember=1&cookie_check=1&_xfToken=&redirect=http%3A%2F%{}%2F".format(uq(username), uq(password), uq(self.domain)).encode())
-    def get_posts(self, soup, url):
-        rv = []
-        for i in soup.find_all("li", class_="message"):
-            #print(i.prettify())
-            if 'deleted' in i['class']: # only admins/mods can see deleted posts, but if that's the account you're using....
-                continue
-            ul = i.find("a", class_="username")
-            poster_name = str(ul.string)
-            poster_url = "{}://{}/{}".format(self.scheme, self.domain, ul['href'])
-            text = str(i.find("blockquote", class_="messageText"))
-            pl = i.find("a", title="Permalink")
-            post_url = "{}://{}/{}".format(self.scheme, self.domain, pl['href'])
-            try:
-                d = i.find(class_="DateTime")
-                if d.name == 'abbr':
-                    date = datetime.datetime.fromtimestamp(int(d['data-time'])).isoformat()
-                elif d.name == 'span':
-                    date = dateutil.parser.parse(d['title']).isoformat()
-                #print(date)
-            except:
-                traceback.print_exc()
-                print(i.prettify())
-                date = ""
-            rv.append({'poster_name': poster_name, 'poster_url': poster_url, 'text': self.process_html(text), 'orig_text': text, 'post_url': post_url, 'date': date})
-        return rv
-    def get_npages(self, soup):
-        try:
-            pages = soup.find("span", class_="pageNavHeader")
-            o = re.match(r"Page \d+ of (\d+)", pages.string)
-            npages = int(o.group(1))
-        except AttributeError:
-            npages = 1
-        return npages
-    def make_page_url(self, page):
-        if type(page) == int:
-            page = "page-{}".format(page)
-        return "{}://{}/threads/{}/{}".format(self.scheme, self.domain, self.tid, page)
-    def get_url_page(self, url=None):
-        if url is None:
-            url = self.url
-        o = re.match(r"https?://[^/]+/threads/[^/]+/?(page-(\d+))?", url)
-        if o:
-            r = o.group(2)
-        else:
-            url = get_redirect(url, opener=self.opener)
-            return self.get_url_page(url)
-        if r is None:
-            return 1
-        else:
-            return int(r)
-    def process_html(self, text):
-        soup = BeautifulSoup(text)
-        del soup.blockquote['class']
-        soup.blockquote.name = 'div'
-        for i in soup(text=True):
-            #print(repr(i))
-            try:
-                if i.isspace():
-                    #print("Deleted")
-                    i.extract()
-                i.replace_with(i.strip("\n\t"))
-            except:
-                pass
-        for i in soup('div', class_="bbCodeQuote"):
-            try:
-                auth = i['data-author']
-            except KeyError:
-                auth = None
-            ne = i.aside.blockquote.div
-            ne = ne.extract()
-            ne.name = 'blockquote'
-            del ne['class']
-            if auth:
-                ne['author'] = auth
-            i.replace_with(ne)
-        return str(soup)
-
-class QQGetter(ThreadGetter):
-    def __init__(self, url, cred={}, *args):
-        ThreadGetter.__init__(self, url)
-        o = re.match(r"(https?://)?questionablequesting.com/index.php\?topic=(?P<tid>\d+)(\.(?P<pc>[^#]+))?(#.+)?", self.url)
-        self.__dict__.update(o.groupdict())
-        cj = cred.get('cookies', http.cookiejar.CookieJar())
-        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj))
-        if not 'cookies' in cred:
-            self.login(**cred)        
-        self.cred = cred
-        self.cred['cookies'] = cj
-    def login(self, username, password, **args):
-        d = self.opener.open('http://questionablequesting.com/index.php?action=login').read()
-        s = BeautifulSoup(d)
-        sid = re.search(r"'([^']+)'", s.find('form', id='frmLogin')['onsubmit']).group(1)
-        hs1 = username.lower() + password
-        hs2 = hashlib.sha1(hs1.encode()).hexdigest() + sid
-        hs3 = hashlib.sha1(hs2.encode()).hexdigest()
-        d = self.opener.open('http://questionablequesting.com/index.php?action=login2', 
-                           data='user={}&passwrd=&cookieneverexp=on&hash_passwrd={}'.format(username, hs3).encode()).read()
-        return d
-    def handle_url(self, url):
-        """This function removes QQ's PHPSESSID component from URLs, which it only
-        inserts if viewing without cookies.
+# The getter classes which used to be defined here, still available as
+# attributes of this module; they are imported when first used.
+_getter_names = { 'FFNGetter': 'forum_getters.ffn:FFNGetter',
+                  'XFGetter': 'forum_getters.xenforo:XFGetter',
+                  'QQGetter': 'forum_getters.smf:QQGetter',
+                  'BLGetter': 'forum_getters.vbulletin:BLGetter',
+                  'TVTGetter': 'forum_getters.tvtropes:TVTGetter', }
 
-        """
-        r = urllib.parse.urlparse(url)
-        n = urllib.parse.parse_qs(r.query)
-        n.pop('PHPSESSID', None)
-        a = urllib.parse.urlencode(n, doseq=True)
-        return urllib.parse.urlunparse((r[0], r[1], r[2], '', a, r[5]))
-    def get_posts(self, soup, url):
-        vclist = []
-        for i in soup('div', class_="post_wrapper"):
-            el = i.find('h5', id=re.compile("subject_"))
-            pl = self.handle_url(el.a['href'])
-            cpn = re.match(r"subject_(\d+)", el['id']).group(1)
-            text = str(i.find('div', class_='inner', id='msg_{}'.format(cpn)))
-            poe = i.find('div', class_='poster').h4.a
-            poster = poe.string
-            prol = self.handle_url(poe['href'])
-            de = i.find('div', class_='smalltext')
-            date = dateutil.parser.parse(de.strong.next_sibling[1:-2]).isoformat()
-            pe = {'poster_name': poster, 'poster_url': prol, 'text': self.process_html(text), 'orig_text': text, 'post_url': pl, 'date': date}
-            vclist.append(pe)
-        return vclist
-    def get_npages(self, soup):
-        pl = soup.find('div', class_='pagelinks')
-        cpage = int(pl.find('strong').string)
-        try:
-            mpage = int(soup.find_all('a', class_='navPages')[-1].string)
-        except IndexError: # no other pages
-            mpage = 1
-        mpage = mpage if mpage > cpage else cpage
-        return mpage
-    def make_page_url(self, page):
-        if type(page) == int:
-            page = str((page - 1) * 50)
-        return "http://questionablequesting.com/index.php?topic={}.{}".format(self.tid, page)
-    def get_url_page(self, url=None):
-        if url is None:
-            return self.pc
-        o = re.match(r"(https?://)?questionablequesting.com/index.php\?topic=(?P<tid>\d+)(\.(?P<pc>[^#]+))?(#.+)?", self.url)
-        r = o.group('pc')
-        return r
-        
-class BLGetter(ThreadGetter):
-    tid = None
-    def get_posts(self, soup, url):
-        rv = []
-        for i in soup.find_all("li", class_="postcontainer"):
-            try: # I officially hate BL's stupid inconsistent date-display code.
-                subd = False
-                de = i.find("span", class_="postdate")
-                dstr = de.span.contents[0][:-2]
-                if dstr == "Today":
-                    dstr = ""
-                if dstr == "Yesterday":
-                    dstr = ""
-                    subd = True
-                dstr += "T" + de.span.span.string
-                date = dateutil.parser.parse(dstr)
-                if subd:
-                    date = date - datetime.timedelta(1)
-                date = date.isoformat()
-            except Exception as e:
-                traceback.print_exc()
-                print(i.prettify())
-                date = ""
-            post_url = "http://forums.nrvnqsr.com/" + i.find("a", class_="postcounter")['href']
-            ul = i.find("a", class_="username")
-            poster_name = ul.string
-            poster_url = "http://forums.nrvnqsr.com/" + ul['href']
-            text = str(i.find("blockquote", class_="postcontent"))
-            rv.append({'poster_name': poster_name, 'poster_url': poster_url, 'text': self.process_html(text), 'orig_text': text, 'post_url': post_url, 'date': date})
-        return rv
-    def get_npages(self, soup):
-        for i in soup.find_all("a", class_="popupctrl"):
-            o = re.match("Page \d+ of (\d+)", i.string)
-            if o:
-                npages = int(o.group(1))
-                break
-        return npages
-    def make_page_url(self, page):
-        if self.tid == None:
-            o = re.match("http://forums.nrvnqsr.com/showthread.php/(\d+).*", self.url)
-            self.tid = o.group(1)
-        return "http://forums.nrvnqsr.com/showthread.php/{}/page{}".format(self.tid, page)
-    def process_html(self, text):
-        soup = BeautifulSoup(text)
-        for i in soup.find_all('div', class_='bbcode_container'):
-            j = i.div
-            i.unwrap()
-            i = j.div
-            j.unwrap()
-#            print(i.prettify())
-            i.div.decompose()
-            i.name = 'blockquote'
-        return str(soup)
-    def get_url_page(self, url=None):
-        if url is None:
-            url = self.url
-        
+def __getattr__(name):
+    if name in _getter_names:
+        return load_getter(_getter_names[name])
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-# Incomplete
-class TVTGetter(ThreadGetter):
-    def get_npages(self, soup):
-        l = list(soup.find_all("a", class_="forumpagebutton"))
-        return int(l[-1].string)
-    def make_page_url(self, page):
-        pass
+def load_getter(name):
+    """Imports and returns the getter class named "module:Class"."""
+    module, cls = name.split(':')
+    return getattr(importlib.import_module(module), cls)
+
+_entry_points = None
+_registry_lock = threading.Lock()
 
-getters = [ ( re.compile("(https?://)?forums.spacebattles.com/"), XFGetter ),
-            ( re.compile("(https?://)?forums.sufficientvelocity.com/"), XFGetter ), 
-            ( re.compile("(https?://)?forums.nrvnqsr.com/"), BLGetter ),
-            ( re.compile("(https?://)?forum.questionablequesting.com/"), XFGetter ), ]
+def find_getter(host):
+    """Returns the getter class registered for host, importing it if necessary,
+    or None if there isn't one."""
+    global _entry_points
+    with _registry_lock:
+        g = registry.get(host)
+        if g is None:
+            if _entry_points is None:
+                import importlib.metadata
+                _entry_points = dict((e.name, e) for e in importlib.metadata.entry_points(group='forum_archive.getters'))
+            e = _entry_points.get(host)
+            if e is None:
+                return None
+            g = registry[host] = e.load()
+        elif isinstance(g, str):
+            g = registry[host] = load_getter(g)
+        return g
 
 def make_getter(url, *args, **kwargs):
     """Make a getter for the given URL, parsing the URL to determine which plugin
-    should be used.
+    should be used: the one registered for its host (with its port, or
+    without), or failing that the first in getters whose pattern matches.
 
     """
+    u = urllib.parse.urlsplit(url if '://' in url else 'http://' + url)
+    host = u.netloc.lower()
+    g = find_getter(host) or find_getter(host.rsplit(':', 1)[0])
+    if g is not None:
+        return g(url, *args, **kwargs)
     for i in getters:
         if i[0].match(url):
             return i[1](url, *args, **kwargs)
     raise ValueError("URL {} didn't match any patterns".format(url))
 
-def store_thread(thread, fname):
-    with gzip.GzipFile(fname, 'w') as of:
-        of.write(json.dumps(thread).encode())
+# os.umask can only be read by setting it, so threads take turns.
+_umask_lock = threading.Lock()
 
-def save_thread(plist, of):
-    html = """<html>
+def replace_file(tmp, fname):
+    """Moves a temporary file made by tempfile.mkstemp into place as fname,
+    atomically, with the permissions the umask gives new files rather than
+    mkstemp's owner-only ones."""
+    with _umask_lock:
+        umask = os.umask(0o22)
+        os.umask(umask)
+    os.chmod(tmp, 0o666 & ~umask)
+    os.replace(tmp, fname)
+
+def store_thread(thread, fname, npages=None):
+    """Writes a thread to a gzipped JSON archive. The thread may be any iterable
+    of posts, such as ThreadGetter.iter_posts(); posts are written one at a
+    time as they arrive. If the number of pages the thread had when downloaded
+    is given, it is stored along with the posts so that update_thread can carry
+    on from there; it may be a function, called once the posts are written,
+    for when it isn't known until then. The file is replaced atomically, so an
+    interrupted write never leaves a damaged archive.
+
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, gzip.GzipFile(fileobj=f, mode='w') as of:
+            of.write(b'[' if npages is None else b'{"posts": [')
+            for n, p in enumerate(thread):
+                if n:
+                    of.write(b', ')
+                of.write(json.dumps(p, default=dict).encode())
+            of.write(b']')
+            if npages is not None:
+                if callable(npages):
+                    npages = npages()
+                of.write(', "npages": {}}}'.format(json.dumps(npages)).encode())
+        replace_file(tmp, fname)
+    except:
+        os.unlink(tmp)
+        raise
+
+def load_thread(fname):
+    """Reads an archive written by store_thread. Returns the list of Posts and the
+    stored number of pages, which is None for archives stored without it."""
+    with gzip.GzipFile(fname, 'r') as f:
+        data = json.loads(f.read().decode())
+    if isinstance(data, list):
+        return [Post(**p) for p in data], None
+    return [Post(**p) for p in data['posts']], data['npages']
+
+def merge_posts(old, new):
+    """Merges a list of newly downloaded posts into an older one. Posts are matched
+    by post_url; a new version of a post replaces the old one in place, and
+    posts not previously seen are appended in order."""
+    rv = list(old)
+    idx = dict((p['post_url'], n) for n, p in enumerate(rv))
+    for p in new:
+        n = idx.get(p['post_url'])
+        if n is None:
+            idx[p['post_url']] = len(rv)
+            rv.append(p)
+        else:
+            rv[n] = p
+    return rv
+
+def update_thread(getter, fname):
+    """Brings the archive fname of the getter's thread up to date, creating it if
+    necessary. Only the last page stored before and any pages added since
+    are downloaded; for archives lacking a page count, the whole thread is.
+    Returns the updated list of posts.
+
+    """
+    try:
+        old, npages = load_thread(fname)
+    except FileNotFoundError:
+        old, npages = [], None
+    if npages is None:
+        thread = getter.get_thread()
+    else:
+        thread = merge_posts(old, getter.iter_posts((npages, None)))
+    store_thread(thread, fname, getter.npages)
+    return thread
+
+thread_head = """<html>
 <head>
 <meta charset="UTF-8">
-<style>
-table { border-collapse: collapse }
-table, tr, td { border: 1px solid black }
-td { padding: 5px }
-.quoteStyle { color: gray; border-left: 5px solid gray; padding: 10px; margin-left: 20px; display: block }
+{title}<style>
+table {{ border-collapse: collapse }}
+table, tr, td {{ border: 1px solid black }}
+td {{ padding: 5px }}
+.quoteStyle {{ color: gray; border-left: 5px solid gray; padding: 10px; margin-left: 20px; display: block }}
 </style>
 </head>
 <body>
-<table>
 """
-    of.write(html)
-    for l in plist:
-        html = '<tr><td><a href="{}">{}</a><br />\n'.format(l['poster_url'], l['poster_name'])
-        html += l['text'] + '\n'
-        html += '<small><a href="{}">{}</a></small>\n</td></tr>\n'.format(l['post_url'], l['date'])
-        of.write(html)
-    html = """</table>
-</body>
+thread_row = """<tr><td><a href="{}">{}</a><br />
+{}
+<small><a href="{}">{}</a></small>
+</td></tr>
+"""
+thread_foot = """</body>
 </html>
 """
-    of.write(html)
+
+def write_rows(plist, of):
+    for l in plist:
+        of.write(thread_row.format(l['poster_url'], l['poster_name'], l['text'], l['post_url'], l['date']))
+
+def save_thread(plist, of):
+    of.write(thread_head.format(title=""))
+    of.write("<table>\n")
+    write_rows(plist, of)
+    of.write("</table>\n")
+    of.write(thread_foot)
+
+def export_thread(plist, dirname, per_page=500, compress=False):
+    """Writes a thread as a set of HTML pages in dirname, each holding per_page
+    posts and linking to the pages before and after it, plus an index.html
+    listing them. Posts are taken from the iterable plist (such as
+    ThreadGetter.iter_posts()) one at a time and written straight out, so the
+    thread is never held in memory. The links between pages are at the bottom
+    of each, once it is known whether another page follows. Returns the
+    number of pages written.
+
+    With compress, the pages are written gzipped, as .html.gz, but linked to
+    as .html: they are for a server which sends precompressed files in place
+    of those asked for, such as nginx with gzip_static, and can't be browsed
+    from disk.
+
+    """
+    os.makedirs(dirname, exist_ok=True)
+    def name(n):
+        return "page-{:04d}.html".format(n)
+    def fopen(fn):
+        fn = os.path.join(dirname, fn)
+        if compress:
+            return io.TextIOWrapper(io.BufferedWriter(gzip.GzipFile(fn + '.gz', 'wb'), 2**20), encoding='utf-8')
+        return open(fn, 'w', encoding='utf-8', buffering=2**20)
+    def nav(n, more):
+        links = ['<a href="index.html">Index</a>']
+        if n > 1:
+            links.insert(0, '<a href="{}">Previous</a>'.format(name(n - 1)))
+        if more:
+            links.append('<a href="{}">Next</a>'.format(name(n + 1)))
+        return "<p>{}</p>\n".format(" | ".join(links))
+    pages = [] # (first poster, first date, number of posts) for each page
+    it = iter(plist)
+    nxt = next(it, None)
+    while nxt is not None:
+        n = len(pages) + 1
+        with fopen(name(n)) as of:
+            of.write(thread_head.format(title="<title>Page {}</title>\n".format(n)))
+            of.write("<table>\n")
+            first, count = nxt, 0
+            while nxt is not None and count < per_page:
+                write_rows((nxt,), of)
+                count += 1
+                nxt = next(it, None)
+            of.write("</table>\n")
+            of.write(nav(n, nxt is not None))
+            of.write(thread_foot)
+        pages.append((first['poster_name'], first['date'], count))
+    with open(os.path.join(dirname, 'index.html'), 'w', encoding='utf-8') as of:
+        of.write(thread_head.format(title="<title>Index</title>\n"))
+        of.write("<ol>\n")
+        for n, (poster, date, count) in enumerate(pages, 1):
+            of.write('<li><a href="{}">Page {}</a>: {} posts from {} ({})</li>\n'.format(name(n), n, count, date, poster))
+        of.write("</ol>\n")
+        of.write(thread_foot)
+    return len(pages)
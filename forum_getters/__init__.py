@@ -0,0 +1,4 @@
+# Getters for each supported forum, one module per forum engine. They are
+# imported by forum_archive.make_getter when a URL on one of their hosts is
+# first seen, through forum_archive.registry, so that nothing is loaded for
+# forums a run doesn't touch.
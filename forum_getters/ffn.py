@@ -0,0 +1,111 @@
+# Getter for the forums of FanFiction.Net.
+
+import re, time, urllib.request, urllib.parse, http.client
+import bs4
+from bs4 import SoupStrainer
+from forum_archive import ThreadGetter, Post, domain_rate, overload_status, backoff, retry_after
+
+class FFNGetter(ThreadGetter):
+    fid = tid = None
+    posts_only = SoupStrainer("table", id="gui_table2i")
+    npages_only = SoupStrainer("center")
+    date_formats = ("%m-%d-%y %I:%M%p",)
+    def get_posts(self, soup, url):
+        rv = []
+        for i in soup.find("table", id="gui_table2i")("td"):
+            poster_name = str(i.a.string)
+            poster_url = "http://www.fanfiction.net" + i.a['href']
+            post_url = url + "#{}".format(i.a['id'])
+            text = ""
+            for p in i.a.next_siblings:
+                if isinstance(p, bs4.element.NavigableString):
+                    if p != " ":
+                        text += "<p>{}</p>\n".format(str(p).encode('utf-8').strip())
+                    continue
+                if p.name == "span":
+                    break
+                text += str(p) + "\n"
+            date = self.parse_date(i.find("span", class_="xdate")['title'])
+            text, orig = self.render_post(text)
+            rv.append(Post(poster_name, poster_url, post_url, text, orig, date))
+        return rv
+    # FFn forums' rendering is so damned inconsistent and full of special cases
+    # it's really not worth trying to extract the number of pages from the
+    # thread page itself. Hence this, which is terrible but works: pages are
+    # probed with HEAD requests, doubling the distance from the last page linked
+    # until one is missing, then bisecting.
+    conn = None
+    # Page counts found before, by (forum id, topic id). Probing starts from
+    # there, so that counting again costs two requests, but still sees pages
+    # added since.
+    found_npages = {}
+    def get_npages(self, soup):
+        self.make_page_url(1) # sets fid and tid
+        key = (self.fid, self.tid)
+        n = self.found_npages.get(key) or 1
+        # Scan for a reasonable starting point, so we aren't going through every page in a 150-page thread.
+        pages = soup.find("center")
+        for i in pages("a"):
+            o = re.match(r"/topic/(\d+)/(\d+)/(\d+).*", i['href'])
+            if o is not None:
+                b = int(o.group(3))
+                if b > n:
+                    n = b
+        if self.page_exists(n):
+            lo, step = n, 1
+            while self.page_exists(lo + step):
+                lo += step
+                step *= 2
+            hi = lo + step
+        else:
+            lo, hi = 0, n
+        while hi - lo > 1: # lo exists (or is 0), hi doesn't
+            mid = (lo + hi) // 2
+            if self.page_exists(mid):
+                lo = mid
+            else:
+                hi = mid
+        self.found_npages[key] = lo
+        return lo
+    def page_exists(self, n):
+        """Sends a HEAD request for page n of the topic, over a connection kept
+        open for the purpose (through the HTTP proxy, if one is configured). A
+        missing page is redirected (302)."""
+        url = self.make_page_url(n)
+        u = urllib.parse.urlsplit(url)
+        host, path = u.netloc, u.path
+        proxy = urllib.request.getproxies().get('http')
+        if proxy and not urllib.request.proxy_bypass(u.netloc):
+            host, path = urllib.parse.urlsplit(proxy).netloc, url
+        l = domain_rate(url)
+        for i in range(3):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(host)
+            l.acquire()
+            t = time.monotonic()
+            try:
+                self.conn.request("HEAD", path)
+                b = self.conn.getresponse()
+                b.read()
+            except (http.client.BadStatusLine, http.client.ResponseNotReady, ConnectionError): # connection was closed
+                self.conn.close()
+                self.conn = None
+                continue
+            if overload_status(b.status):
+                l.overloaded()
+                time.sleep(max(backoff(i, 1), retry_after(b.headers) or 0))
+                continue
+            l.success(time.monotonic() - t)
+            if b.status == 200:
+                return True
+            elif b.status == 302:
+                return False # This is the response we get if the page is invalid
+            else:
+                raise Exception("Invalid status: {}".format(b.status))
+        raise http.client.HTTPException("Connection to {} keeps closing".format(host))
+    def make_page_url(self, page):
+        if self.fid == None or self.tid == None:
+            o = re.match("http://www.fanfiction.net/topic/(\d+)/(\d+).*", self.url)
+            self.fid = o.group(1)
+            self.tid = o.group(2)
+        return "http://www.fanfiction.net/topic/{}/{}/{}".format(self.fid, self.tid, page)
@@ -0,0 +1,72 @@
+# Getter for the old Simple Machines Forum of Questionable Questing.
+
+import re, hashlib, urllib.parse
+from bs4 import SoupStrainer
+from forum_archive import ThreadGetter, Post, make_soup, has_class
+
+class QQGetter(ThreadGetter):
+    posts_only = SoupStrainer("div", class_=has_class("post_wrapper"))
+    npages_only = SoupStrainer("div", class_=has_class("pagelinks"))
+    session_cookie = r"SMFCookie"
+    date_formats = ("%B %d, %Y, %I:%M:%S %p",)
+    def __init__(self, url, cred={}, *args):
+        cj = self.start_session('questionablequesting.com', cred)
+        ThreadGetter.__init__(self, url)
+        o = re.match(r"(https?://)?questionablequesting.com/index.php\?topic=(?P<tid>\d+)(\.(?P<pc>[^#]+))?(#.+)?", self.url)
+        self.__dict__.update(o.groupdict())
+        self.cred = cred
+        self.cred['cookies'] = cj
+    def login(self, username, password, **args):
+        d = self.opener.open('http://questionablequesting.com/index.php?action=login').read()
+        s = make_soup(d, SoupStrainer('form', id='frmLogin'))
+        sid = re.search(r"'([^']+)'", s.find('form', id='frmLogin')['onsubmit']).group(1)
+        hs1 = username.lower() + password
+        hs2 = hashlib.sha1(hs1.encode()).hexdigest() + sid
+        hs3 = hashlib.sha1(hs2.encode()).hexdigest()
+        d = self.opener.open('http://questionablequesting.com/index.php?action=login2', 
+                           data='user={}&passwrd=&cookieneverexp=on&hash_passwrd={}'.format(username, hs3).encode()).read()
+        return d
+    def handle_url(self, url):
+        """This function removes QQ's PHPSESSID component from URLs, which it only
+        inserts if viewing without cookies.
+
+        """
+        r = urllib.parse.urlparse(url)
+        n = urllib.parse.parse_qs(r.query)
+        n.pop('PHPSESSID', None)
+        a = urllib.parse.urlencode(n, doseq=True)
+        return urllib.parse.urlunparse((r[0], r[1], r[2], '', a, r[5]))
+    def get_posts(self, soup, url):
+        vclist = []
+        for i in soup('div', class_="post_wrapper"):
+            el = i.find('h5', id=re.compile("subject_"))
+            pl = self.handle_url(el.a['href'])
+            cpn = re.match(r"subject_(\d+)", el['id']).group(1)
+            text, orig = self.render_post(i.find('div', class_='inner', id='msg_{}'.format(cpn)))
+            poe = i.find('div', class_='poster').h4.a
+            poster = poe.string
+            prol = self.handle_url(poe['href'])
+            de = i.find('div', class_='smalltext')
+            date = self.parse_date(de.strong.next_sibling[1:-2])
+            pe = Post(poster, prol, pl, text, orig, date)
+            vclist.append(pe)
+        return vclist
+    def get_npages(self, soup):
+        pl = soup.find('div', class_='pagelinks')
+        cpage = int(pl.find('strong').string)
+        try:
+            mpage = int(soup.find_all('a', class_='navPages')[-1].string)
+        except IndexError: # no other pages
+            mpage = 1
+        mpage = mpage if mpage > cpage else cpage
+        return mpage
+    def make_page_url(self, page):
+        if type(page) == int:
+            page = str((page - 1) * 50)
+        return "http://questionablequesting.com/index.php?topic={}.{}".format(self.tid, page)
+    def get_url_page(self, url=None):
+        if url is None:
+            return self.pc
+        o = re.match(r"(https?://)?questionablequesting.com/index.php\?topic=(?P<tid>\d+)(\.(?P<pc>[^#]+))?(#.+)?", self.url)
+        r = o.group('pc')
+        return r
@@ -0,0 +1,11 @@
+# Getter for the TV Tropes forums.
+
+from forum_archive import ThreadGetter
+
+# Incomplete
+class TVTGetter(ThreadGetter):
+    def get_npages(self, soup):
+        l = list(soup.find_all("a", class_="forumpagebutton"))
+        return int(l[-1].string)
+    def make_page_url(self, page):
+        pass
@@ -0,0 +1,62 @@
+# Getter for the vBulletin forum of Beast's Lair.
+
+import re, datetime, traceback
+from bs4 import SoupStrainer
+from forum_archive import ThreadGetter, Post, make_soup, has_class
+
+class BLGetter(ThreadGetter):
+    tid = None
+    posts_only = SoupStrainer("li", class_=has_class("postcontainer"))
+    npages_only = SoupStrainer("a", class_=has_class("popupctrl"))
+    date_formats = ("%m-%d-%Y %I:%M %p",)
+    def get_posts(self, soup, url):
+        rv = []
+        for i in soup.find_all("li", class_="postcontainer"):
+            try: # I officially hate BL's stupid inconsistent date-display code.
+                de = i.find("span", class_="postdate")
+                dstr = de.span.contents[0][:-2]
+                if dstr in ("Today", "Yesterday"):
+                    # In the forum's zone if known, else this machine's.
+                    day = datetime.datetime.now(self.date_timezone()).date()
+                    if dstr == "Yesterday":
+                        day -= datetime.timedelta(1)
+                    dstr = day.strftime("%m-%d-%Y")
+                date = self.parse_date("{} {}".format(dstr, de.span.span.string))
+            except Exception as e:
+                traceback.print_exc()
+                print(i.prettify())
+                date = ""
+            post_url = "http://forums.nrvnqsr.com/" + i.find("a", class_="postcounter")['href']
+            ul = i.find("a", class_="username")
+            poster_name = ul.string
+            poster_url = "http://forums.nrvnqsr.com/" + ul['href']
+            text, orig = self.render_post(i.find("blockquote", class_="postcontent"))
+            rv.append(Post(poster_name, poster_url, post_url, text, orig, date))
+        return rv
+    def get_npages(self, soup):
+        for i in soup.find_all("a", class_="popupctrl"):
+            o = re.match("Page \d+ of (\d+)", i.string)
+            if o:
+                npages = int(o.group(1))
+                break
+        return npages
+    def make_page_url(self, page):
+        if self.tid == None:
+            o = re.match("http://forums.nrvnqsr.com/showthread.php/(\d+).*", self.url)
+            self.tid = o.group(1)
+        return "http://forums.nrvnqsr.com/showthread.php/{}/page{}".format(self.tid, page)
+    def process_html(self, el):
+        if isinstance(el, str):
+            el = make_soup(el).blockquote
+        for i in el.find_all('div', class_='bbcode_container'):
+            j = i.div
+            i.unwrap()
+            i = j.div
+            j.unwrap()
+#            print(i.prettify())
+            i.div.decompose()
+            i.name = 'blockquote'
+        return str(el)
+    def get_url_page(self, url=None):
+        if url is None:
+            url = self.url
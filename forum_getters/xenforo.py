@@ -0,0 +1,117 @@
+# Getter for XenForo forums, among them SpaceBattles, Sufficient Velocity and
+# Questionable Questing.
+
+import re, datetime, traceback, urllib.request, urllib.parse, zoneinfo
+import bs4
+from bs4 import SoupStrainer
+from forum_archive import ThreadGetter, Post, make_soup, has_class, get_redirect
+
+class XFGetter(ThreadGetter):
+    """This class is designed to retrieve threads from XenForo forums, including
+    Spacebattles and Sufficient Velocity. The domain is inferred from the thread
+    URL.
+
+    """
+    posts_only = SoupStrainer("li", class_=has_class("message"))
+    npages_only = SoupStrainer("span", class_=has_class("pageNavHeader"))
+    session_cookie = r"xf_user$"
+    date_formats = ("%b %d, %Y at %I:%M %p",)
+    # XenForo's default for guests. Forums can choose another, and accounts
+    # their own; see forum_archive.timezones.
+    timezone = zoneinfo.ZoneInfo("Europe/London")
+    def __init__(self, url, cred={}, *args):
+        o = re.match("((?P<scheme>https?)://)?(?P<domain>[^/]+)/", url)
+        self.domain = o.group('domain')
+        self.scheme = o.group('scheme')
+        cj = self.start_session(self.domain, cred)
+        self.cred = cred
+        self.cred['cookies'] = cj
+        url = get_redirect(url, opener=self.opener)
+        ThreadGetter.__init__(self, url)
+        o = re.match(r"https?://[^/]+/threads/[^.]+\.(\d+).*", self.url)
+        self.tid = o.group(1)
+    def login(self, username, password, **args):
+        ue = urllib.parse.urlencode
+        req = urllib.request.Request('{}://{}/'.format(self.scheme, self.domain)) #, headers={"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0) Gecko/20100101 Firefox/21.0"})
+        self.opener.open(req)
+        req = urllib.request.Request('{}://{}/login/login'.format(self.scheme, self.domain)) #, headers={"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0) Gecko/20100101 Firefox/21.0"})
+        r = self.opener.open(req, data=ue({'login': username, 'password': password, 'redirect': '{}://{}/'.format(self.scheme, self.domain),
+                                           'register': '0', 'remember': '1', 'cookie_check': '1', '_xfToken': ''}).encode())
+        return r.read()
+#                         data="login={}&register=0&password={}&remember=1&cookie_check=1&_xfToken=&redirect=http%3A%2F%{}%2F".format(uq(username), uq(password), uq(self.domain)).encode())
+    def get_posts(self, soup, url):
+        rv = []
+        for i in soup.find_all("li", class_="message"):
+            #print(i.prettify())
+            if 'deleted' in i['class']: # only admins/mods can see deleted posts, but if that's the account you're using....
+                continue
+            ul = i.find("a", class_="username")
+            poster_name = str(ul.string)
+            poster_url = "{}://{}/{}".format(self.scheme, self.domain, ul['href'])
+            text, orig = self.render_post(i.find("blockquote", class_="messageText"))
+            pl = i.find("a", title="Permalink")
+            post_url = "{}://{}/{}".format(self.scheme, self.domain, pl['href'])
+            try:
+                d = i.find(class_="DateTime")
+                if d.name == 'abbr':
+                    date = datetime.datetime.fromtimestamp(int(d['data-time']), datetime.timezone.utc).isoformat()
+                elif d.name == 'span':
+                    date = self.parse_date(d['title'])
+                #print(date)
+            except:
+                traceback.print_exc()
+                print(i.prettify())
+                date = ""
+            rv.append(Post(poster_name, poster_url, post_url, text, orig, date))
+        return rv
+    def get_npages(self, soup):
+        try:
+            pages = soup.find("span", class_="pageNavHeader")
+            o = re.match(r"Page \d+ of (\d+)", pages.string)
+            npages = int(o.group(1))
+        except AttributeError:
+            npages = 1
+        return npages
+    def make_page_url(self, page):
+        if type(page) == int:
+            page = "page-{}".format(page)
+        return "{}://{}/threads/{}/{}".format(self.scheme, self.domain, self.tid, page)
+    def get_url_page(self, url=None):
+        if url is None:
+            url = self.url
+        o = re.match(r"https?://[^/]+/threads/[^/]+/?(page-(\d+))?", url)
+        if o:
+            r = o.group(2)
+        else:
+            url = get_redirect(url, opener=self.opener)
+            return self.get_url_page(url)
+        if r is None:
+            return 1
+        else:
+            return int(r)
+    def process_html(self, el):
+        if isinstance(el, str):
+            el = make_soup(el).blockquote
+        del el['class']
+        el.name = 'div'
+        # One walk over the post does everything: whitespace-only strings are
+        # dropped and others trimmed, and quotes are turned into blockquotes.
+        # The contents of a quote are visited after it, so get trimmed too.
+        for i in list(el.descendants):
+            if isinstance(i, bs4.element.NavigableString):
+                if i.isspace():
+                    i.extract()
+                else:
+                    t = i.strip("\n\t")
+                    if t != i:
+                        i.replace_with(t)
+            elif i.name == 'div' and 'bbCodeQuote' in i.get('class', ()):
+                auth = i.get('data-author')
+                ne = i.aside.blockquote.div
+                ne = ne.extract()
+                ne.name = 'blockquote'
+                del ne['class']
+                if auth:
+                    ne['author'] = auth
+                i.replace_with(ne)
+        return str(el)
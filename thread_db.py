@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+# This module stores archived threads in an SQLite database instead of a file
+# per thread, so that posts can be looked up by thread, poster and date, and
+# searched by text, across everything archived. Posts are keyed on post_url, so
+# storing a thread again only updates what has changed.
+#
+# Run as a script, it imports archives and queries the database.
+
+import forum_archive, sqlite3, re, html, time, argparse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (id INTEGER PRIMARY KEY, url TEXT UNIQUE NOT NULL,
+    npages INTEGER, updated REAL);
+CREATE TABLE IF NOT EXISTS posts (id INTEGER PRIMARY KEY, thread INTEGER NOT NULL REFERENCES threads,
+    seq INTEGER NOT NULL, post_url TEXT UNIQUE NOT NULL, poster_name TEXT, poster_url TEXT,
+    date TEXT, text TEXT);
+CREATE INDEX IF NOT EXISTS posts_thread ON posts (thread, seq);
+CREATE INDEX IF NOT EXISTS posts_poster ON posts (poster_name);
+CREATE INDEX IF NOT EXISTS posts_date ON posts (date);
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5 (body, tokenize='unicode61');
+"""
+
+def plain_text(text):
+    """Reduces post HTML to the words to be indexed."""
+    return html.unescape(re.sub(r"<[^>]*>", " ", text or ""))
+
+class ThreadDB:
+    """An SQLite database of threads. Posts are written in batches, each in one
+    transaction, and upserted by post_url; the text of each is also indexed for
+    full-text search.
+
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+    def thread_id(self, url, npages=None):
+        self.db.execute("INSERT INTO threads (url, npages, updated) VALUES (?, ?, ?) "
+                        "ON CONFLICT (url) DO UPDATE SET npages = COALESCE(excluded.npages, npages), "
+                        "updated = excluded.updated", (url, npages, time.time()))
+        return self.db.execute("SELECT id FROM threads WHERE url = ?", (url,)).fetchone()[0]
+    def store(self, url, posts, npages=None, batch=500):
+        """Stores posts (any iterable, such as ThreadGetter.iter_posts()) as
+        belonging to the thread url, committing every batch posts. Posts already
+        stored are updated in place and keep their position in the thread; new
+        ones are added after the rest. npages may be a function, called once
+        the posts have been stored. Returns the number of posts written.
+
+        """
+        with self.db:
+            tid = self.thread_id(url)
+            seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM posts WHERE thread = ?", (tid,)).fetchone()[0]
+        n = 0
+        it = iter(posts)
+        while True:
+            chunk = [p for _, p in zip(range(batch), it)]
+            if not chunk:
+                break
+            with self.db:
+                for p in chunk:
+                    seq += 1
+                    pid = self.db.execute(
+                        "INSERT INTO posts (thread, seq, post_url, poster_name, poster_url, date, text) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (post_url) DO UPDATE SET "
+                        "poster_name = excluded.poster_name, poster_url = excluded.poster_url, "
+                        "date = excluded.date, text = excluded.text RETURNING id",
+                        (tid, seq, p['post_url'], p['poster_name'], p['poster_url'], p['date'], p['text'])).fetchone()[0]
+                    self.db.execute("DELETE FROM posts_fts WHERE rowid = ?", (pid,))
+                    self.db.execute("INSERT INTO posts_fts (rowid, body) VALUES (?, ?)", (pid, plain_text(p['text'])))
+            n += len(chunk)
+        with self.db:
+            self.thread_id(url, npages() if callable(npages) else npages)
+        return n
+    def rows(self, where, args):
+        q = ("SELECT t.url, p.post_url, p.poster_name, p.poster_url, p.date, p.text FROM posts p "
+             "JOIN threads t ON t.id = p.thread WHERE {} ORDER BY p.thread, p.seq".format(where))
+        return self.db.execute(q, args).fetchall()
+    def to_post(self, r):
+        return forum_archive.Post(r[2], r[3], r[1], r[5], None, r[4])
+    def thread(self, url):
+        """Returns the list of Posts stored for the thread url, in order."""
+        return [self.to_post(r) for r in self.rows("t.url = ?", (url,))]
+    def threads(self):
+        """Returns a list of (url, number of posts, npages) for every thread."""
+        return self.db.execute("SELECT t.url, COUNT(p.id), t.npages FROM threads t "
+                               "LEFT JOIN posts p ON p.thread = t.id GROUP BY t.id ORDER BY t.url").fetchall()
+    def by_poster(self, name, thread=None, since=None, until=None):
+        """Returns (thread url, Post) for every post by the named poster,
+        optionally only in one thread or between two ISO dates."""
+        where, args = ["p.poster_name = ?"], [name]
+        if thread is not None:
+            where.append("t.url = ?")
+            args.append(thread)
+        if since is not None:
+            where.append("p.date >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("p.date < ?")
+            args.append(until)
+        return [(r[0], self.to_post(r)) for r in self.rows(" AND ".join(where), args)]
+    def search(self, query, limit=100):
+        """Full-text search over all posts, using SQLite FTS5 query syntax.
+        Returns (thread url, Post) for the best matches."""
+        rs = self.db.execute(
+            "SELECT t.url, p.post_url, p.poster_name, p.poster_url, p.date, p.text FROM posts_fts f "
+            "JOIN posts p ON p.id = f.rowid JOIN threads t ON t.id = p.thread "
+            "WHERE posts_fts MATCH ? ORDER BY rank LIMIT ?", (query, limit)).fetchall()
+        return [(r[0], self.to_post(r)) for r in rs]
+    def threads_mentioning(self, query):
+        """Returns the URLs of all threads with a post matching query."""
+        return [r[0] for r in self.db.execute(
+            "SELECT DISTINCT t.url FROM posts_fts f JOIN posts p ON p.id = f.rowid "
+            "JOIN threads t ON t.id = p.thread WHERE posts_fts MATCH ? ORDER BY t.url", (query,))]
+    def close(self):
+        self.db.close()
+
+def main():
+    ap = argparse.ArgumentParser(description="Thread archive database")
+    ap.add_argument("db", help="Database file")
+    sp = ap.add_subparsers(dest="cmd", required=True)
+    p = sp.add_parser("import", help="Import archives written by store_thread")
+    p.add_argument("url", help="URL of the archived thread")
+    p.add_argument("file", help="Archive file (.json.gz)")
+    p = sp.add_parser("search", help="Search post text")
+    p.add_argument("query")
+    p.add_argument("-n", type=int, default=20, help="Number of results")
+    p.add_argument("-t", "--threads", action="store_true", help="List matching threads only", default=False)
+    p = sp.add_parser("poster", help="List posts by a poster")
+    p.add_argument("name")
+    sp.add_parser("threads", help="List stored threads")
+    args = ap.parse_args()
+    db = ThreadDB(args.db)
+    if args.cmd == "import":
+        posts, npages = forum_archive.load_thread(args.file)
+        print("{} posts".format(db.store(args.url, posts, npages)))
+    elif args.cmd == "search" and args.threads:
+        for i in db.threads_mentioning(args.query):
+            print(i)
+    elif args.cmd == "search":
+        for t, p in db.search(args.query, args.n):
+            print("{} {} {}".format(p['date'], p['poster_name'], p['post_url']))
+    elif args.cmd == "poster":
+        for t, p in db.by_poster(args.name):
+            print("{} {}".format(p['date'], p['post_url']))
+    elif args.cmd == "threads":
+        for url, n, npages in db.threads():
+            print("{} {} posts, {} pages".format(url, n, npages))
+    db.close()
+
+if __name__=="__main__":
+    main()
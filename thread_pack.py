@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+# This module provides a thread archive format which, unlike the gzipped JSON
+# written by forum_archive.store_thread, can be written a page at a time and
+# read back a page or a post at a time. A pack file is:
+#
+#   magic      b"FAPK\x01\n"
+#   blocks     one zlib-compressed JSON list of posts per page, back to back
+#   index      zlib-compressed JSON: the page, offset, length and number of posts
+#              of each block, the block and position of each post by post URL,
+#              and the number of pages in the thread if known
+#   trailer    offset and length of the index as two big-endian 64-bit
+#              integers, then b"FAPKIDX\n"
+#
+# Run as a script, it converts existing .json.gz archives to packs.
+
+import forum_archive, zlib, json, struct, mmap, os, tempfile, re, argparse, sys
+
+MAGIC = b"FAPK\x01\n"
+TRAILER = struct.Struct(">QQ8s")
+TMAGIC = b"FAPKIDX\n"
+
+class PackWriter:
+    """Writes a pack file incrementally. Call add_page for each page in order,
+    then close; the file only appears under its name once closed, so a pack is
+    never left half-written. Can be used as a context manager.
+
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+        self.f.write(MAGIC)
+        self.pages, self.posts = [], {}
+    def add_page(self, page, posts):
+        """Appends the list of posts from page as a new block."""
+        posts = [dict(p) for p in posts]
+        b = zlib.compress(json.dumps(posts).encode())
+        n = len(self.pages)
+        self.pages.append([page, self.f.tell(), len(b), len(posts)])
+        self.f.write(b)
+        for i, p in enumerate(posts):
+            self.posts[p['post_url']] = [n, i]
+    def close(self, npages=None):
+        idx = zlib.compress(json.dumps({'pages': self.pages, 'posts': self.posts, 'npages': npages}).encode())
+        off = self.f.tell()
+        self.f.write(idx)
+        self.f.write(TRAILER.pack(off, len(idx), TMAGIC))
+        self.f.close()
+        forum_archive.replace_file(self.tmp, self.fname)
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmp)
+    def __enter__(self):
+        return self
+    def __exit__(self, t, v, tb):
+        if t is None:
+            self.close()
+        else:
+            self.abort()
+
+def write_pack(pages, fname, npages=None):
+    """Writes an iterable of (page, posts) tuples, such as
+    ThreadGetter.iter_pages() gives, to a pack file. npages may be a function,
+    called once the pages have been written."""
+    w = PackWriter(fname)
+    try:
+        for page, posts in pages:
+            w.add_page(page, posts)
+    except:
+        w.abort()
+        raise
+    w.close(npages() if callable(npages) else npages)
+
+class PackReader:
+    """Reads a pack file. The file is memory-mapped and only the index is
+    decoded up front; pages and posts are decompressed when asked for."""
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a pack file".format(fname))
+        off, n, m = TRAILER.unpack(self.mm[-TRAILER.size:])
+        if m != TMAGIC:
+            raise ValueError("{} has no index".format(fname))
+        idx = json.loads(zlib.decompress(self.mm[off:off+n]).decode())
+        self.blocks, self.index, self.npages = idx['pages'], idx['posts'], idx['npages']
+        self.by_page = dict((b[0], n) for n, b in enumerate(self.blocks))
+    def block(self, n):
+        page, off, length, count = self.blocks[n]
+        return [forum_archive.Post(**p) for p in json.loads(zlib.decompress(self.mm[off:off+length]).decode())]
+    def pages(self):
+        """Returns the list of pages stored, in order."""
+        return [b[0] for b in self.blocks]
+    def page(self, page):
+        """Returns the list of Posts on the given page."""
+        return self.block(self.by_page[page])
+    def post(self, post_url):
+        """Returns the Post with the given post URL, decoding only its page."""
+        n, i = self.index[post_url]
+        return self.block(n)[i]
+    def iter_pages(self):
+        for n, b in enumerate(self.blocks):
+            yield b[0], self.block(n)
+    def __iter__(self):
+        for page, posts in self.iter_pages():
+            yield from posts
+    def __len__(self):
+        return sum(b[3] for b in self.blocks)
+    def __contains__(self, post_url):
+        return post_url in self.index
+    def close(self):
+        self.mm.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+# Patterns extracting a page number from the post URLs of each forum. QQ's
+# (topic=N.msgM) name only the post, not its page.
+page_patterns = [ (re.compile(r".*/threads/[^/]+/page-(\d+)"), lambda o: int(o.group(1))),
+                  (re.compile(r".*/showthread\.php/\d+[^/]*/page(\d+)"), lambda o: int(o.group(1))),
+                  (re.compile(r".*/topic/\d+/\d+/(\d+)"), lambda o: int(o.group(1))), ]
+
+def post_page(post_url):
+    for r, f in page_patterns:
+        o = r.match(post_url)
+        if o:
+            return f(o)
+    return None
+
+def convert(src, dest, chunk=50):
+    """Converts an archive written by store_thread to a pack file. Posts are
+    grouped by the page their URL names. Where that can't be worked out for
+    every post, or the pages named are out of order, runs of chunk posts are
+    stored as numbered pages instead, so that no page is stored twice."""
+    posts, npages = forum_archive.load_thread(src)
+    pgs = [post_page(p['post_url']) for p in posts]
+    if None in pgs or any(a > b for a, b in zip(pgs, pgs[1:])):
+        pgs = [n // chunk + 1 for n in range(len(posts))]
+    def pages():
+        cur, block = None, []
+        for p, pg in zip(posts, pgs):
+            if block and pg != cur:
+                yield cur, block
+                block = []
+            cur = pg
+            block.append(p)
+        if block:
+            yield cur, block
+    write_pack(pages(), dest, npages)
+
+def main():
+    ap = argparse.ArgumentParser(description="Convert thread archives to pack files")
+    ap.add_argument("files", nargs='+', help="Archives (.json.gz) to convert; each is written alongside as .pack")
+    args = ap.parse_args()
+    for i in args.files:
+        dest = re.sub(r"(\.json)?(\.gz)?$", "", i) + ".pack"
+        convert(i, dest)
+        print("{} -> {}".format(i, dest), file=sys.stderr)
+
+if __name__=="__main__":
+    main()
@@ -3,9 +3,8 @@
 # This program uses forum_archive to download a story thread, and then a
 # manually compiled list of story chapters to create a single story ebook file.
 
-import forum_archive, html2text, urllib.request, markdown, urllib.error
-import argparse, tempfile, os, subprocess, re, sys, urllib.parse
-from bs4 import BeautifulSoup
+import forum_archive, urllib.request, urllib.error
+import argparse, tempfile, os, subprocess, re, sys, urllib.parse, collections
 
 get_redirect = forum_archive.get_redirect
 
@@ -17,32 +16,51 @@ def get_postnum(url):
     if o:
         return o.group(1)
 
-def download_story(chapters):
+def download_story(chapters, cred={}):
     """Takes a list of chapters, returns a list of strings with chapter text.
     chapters is a list of tuples (title, url), where url points to a chapter
-    post directly.
+    post directly; cred, if given, is passed to the getters. The page holding
+    every chapter is worked out before anything is downloaded, so that each
+    distinct page is fetched only once however the chapters are spread over
+    them.
 
     """
-    cthread, rlist = [], []
-    lerr = ""
+    threads = collections.OrderedDict() # first page URL -> (getter, [pages])
+    getters = {} # thread prefix -> getter, so that each thread gets one
+    hosts = {} # host -> a getter there, to resolve links to posts with
+    where = []
     for i in chapters:
-        while True:
-            try:
-                if get_postnum(i[1]) is None:
-                    n = 0
-                else:
-                    n = [get_postnum(j['post_url']) for j in cthread].index(get_postnum(i[1]))
-                rlist.append((i[0], cthread[n]['text']))
-            except (ValueError, IndexError):
-                if lerr == i[1]:
-                    raise
-                print("Getting thread for URL {}".format(i[1]))
-                lerr = i[1]
-                g = forum_archive.make_getter(i[1])
-                pn = g.get_url_page(i[1])
-                cthread = g.get_thread(pn)
-                continue
-            break
+        url = i[1]
+        host = urllib.parse.urlsplit(url).netloc
+        if thread_prefix(url) is None and host in hosts:
+            # Which thread a post is in is only known once its link is resolved.
+            url = get_redirect(url, opener=hosts[host].opener)
+        g = getters.get(thread_prefix(url))
+        if g is None:
+            g = forum_archive.make_getter(url, cred)
+            hosts.setdefault(host, g)
+            if thread_prefix(g.url):
+                getters[thread_prefix(g.url)] = g
+        pn = g.get_url_page(url)
+        key = g.make_page_url(1)
+        g, pl = threads.setdefault(key, (g, []))
+        if pn not in pl:
+            pl.append(pn)
+        where.append((i, key, pn, get_postnum(i[1])))
+    pages, posts = {}, {}
+    for key, (g, pl) in threads.items():
+        print("Getting {} pages for URL {}".format(len(pl), key))
+        for pn, plist in g.iter_pages(pl):
+            pages[key, pn] = plist
+            for j in plist:
+                posts[key, get_postnum(j['post_url'])] = j
+    rlist = []
+    for i, key, pn, n in where:
+        try:
+            p = pages[key, pn][0] if n is None else posts[key, n]
+        except (KeyError, IndexError):
+            raise ValueError("Chapter {} not found at {}".format(i[0], i[1]))
+        rlist.append((i[0], p['text']))
     return rlist
 
 def to_string(chapters):
@@ -76,10 +94,44 @@ def make_toc(contents):
     rs += "</ol>\n"
     return rs
 
-def compile_story(title, chapters, urls, outfile, headers=True, contents=False):
+def render_chapter(text):
+    """Converts the HTML text of a chapter post to the HTML written out."""
+    import html2text, markdown # only needed once a story is compiled
+    t2 = re.sub(r"(\s+)</([^>]+)>", r"</\2>\1", text)
+    return markdown.markdown(html2text.html2text(t2)) # Seems to be best available way to quickly get sane HTML
+
+class RenderCache:
+    """Chapters already converted by render_chapter, kept as files in a
+    directory under a hash of their text and the converters' versions."""
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+        import html2text, markdown
+        self.salt = "{} {}".format(getattr(html2text, '__version__', ''), getattr(markdown, '__version__', ''))
+    def path(self, text):
+        import hashlib
+        h = hashlib.sha1((self.salt + '\0' + text).encode()).hexdigest()
+        return os.path.join(self.dirname, h + '.html')
+    def get(self, text):
+        try:
+            with open(self.path(text), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    def put(self, text, html):
+        fn = self.path(text)
+        with open(fn + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(fn + '.tmp', fn)
+
+def compile_story(title, chapters, urls, outfile, headers=True, contents=False, max_workers=None, cache=None):
     """Takes a list of chapter text strings from download_story, writes them to a
     nice HTML file. HTML is written to the stream passed as outfile.
 
+    Chapters are converted on a pool of max_workers processes (by default one
+    per CPU), and written in order as they become ready. If a RenderCache is
+    given, chapters found in it aren't converted again.
+
     """
     outfile.write("""<html>
 <head>
@@ -102,37 +154,72 @@ body {{ font-family: sans-serif }}
         outfile.write("<h1>{}</h1>\n".format(title[0]))
     if contents:
         outfile.write(make_toc([i[0] for i in chapters]))
-    for n, t in enumerate(chapters):
-        x = n + 1
-        t2 = re.sub(r"(\s+)</([^>]+)>", r"</\2>\1", t[1])
-        text = markdown.markdown(html2text.html2text(t2)) # Seems to be best available way to quickly get sane HTML
-        if headers:
-            outfile.write("""<h2 id="ch{}" class="chapter">{}</h2>\n""".format(x, t[0]))
-        outfile.write(text + "\n\n")
+    done = [cache.get(t[1]) if cache else None for t in chapters]
+    todo = [t[1] for t, d in zip(chapters, done) if d is None]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    ex = None
+    if max_workers > 1 and len(todo) > 1:
+        import concurrent.futures
+        ex = concurrent.futures.ProcessPoolExecutor(min(max_workers, len(todo)))
+        rendered = ex.map(render_chapter, todo, chunksize=max(1, len(todo) // (8 * max_workers)))
+    else:
+        rendered = map(render_chapter, todo)
+    try:
+        for n, t in enumerate(chapters):
+            x = n + 1
+            text = done[n]
+            if text is None:
+                text = next(rendered)
+                if cache:
+                    cache.put(t[1], text)
+            if headers:
+                outfile.write("""<h2 id="ch{}" class="chapter">{}</h2>\n""".format(x, t[0]))
+            outfile.write(text + "\n\n")
+    finally:
+        if ex is not None:
+            ex.shutdown(cancel_futures=True)
     outfile.write("</body>\n</html>\n")
 
 
-def make_listing(html, url):
+def thread_prefix(url):
+    o = re.match(r"https?://[^/]+/threads/[^/]+/", url)
+    if o:
+        return o.group(0)
+
+def make_listing(html, url, max_workers=8):
     """Takes some HTML with links in it, returns a list of (title, url) tuples
     suitable to pass to compile_story. Designed for extracting from
     table-of-contents pages. Calls get_redirect on all URLs, for the purpose of
-    normalizing them. (This may fail on non-XF fora. Fix it later.)
+    normalizing them, up to max_workers at once; links to posts in the same
+    thread as url are already normal and left alone. (This may fail on non-XF
+    fora. Fix it later.)
 
     """
-    soup = BeautifulSoup(html)
-    it = soup.find_all('a')
-    l = len(it)
-    for n, i in enumerate(it):
-        print("{}/{}".format(n+1, l), end='\r')
+    soup = forum_archive.make_soup(html)
+    tp = thread_prefix(url)
+    links = []
+    for i in soup.find_all('a'):
         pr = urllib.parse.urlparse(i['href'])
-        if not pr.netloc:
+        if not pr.netloc and not pr.path and pr.fragment:
+            u = url.split('#')[0] + '#' + pr.fragment
+        elif not pr.netloc:
             u = urllib.parse.urljoin(url, ('' if pr.path.startswith('/') else '/') + pr.path + ('#' + pr.fragment if pr.fragment else ''))
         else:
             u = i['href']
+        links.append((i.string, u))
+    def resolve(link):
+        if tp and thread_prefix(link[1]) == tp and get_postnum(link[1]):
+            return link
         try:
-            yield (i.string, get_redirect(u))
+            return (link[0], get_redirect(link[1]))
         except urllib.error.HTTPError:
-            continue
+            return None
+    l = len(links)
+    for n, r in enumerate(forum_archive.ordered_map(resolve, links, max_workers)):
+        print("{}/{}".format(n+1, l), end='\r')
+        if r is not None:
+            yield r
     print("\n", end="")
 
 def make_filename(title):
@@ -165,6 +252,21 @@ def main():
     ap.add_argument("-a", "--author", help="Override author name", default=None)
     ap.add_argument("-t", "--thread", action="store_true", help="Download archive thread", default=False)
     ap.add_argument("-c", "--credential", help="Log in with credentials", default=None)
+    ap.add_argument("-j", "--jobs", type=int, help="Number of pages to download at once", default=1)
+    ap.add_argument("-P", "--parse-processes", type=int, help="Number of processes parsing downloaded pages", default=0)
+    ap.add_argument("--cache", help="Keep downloaded pages in this cache file", default=None)
+    ap.add_argument("--cache-ttl", type=float, help="Seconds before a cached page is revalidated", default=0)
+    ap.add_argument("--offline", action="store_true", help="Use only pages in the cache", default=False)
+    ap.add_argument("--links", help="File remembering where links lead between runs",
+                    default=forum_archive.cache_path('thread_story_links.json'))
+    ap.add_argument("--timezone", action="append", default=[],
+                    help="Timezone of a forum's dates, given as host=zone, e.g. forums.spacebattles.com=America/New_York; may be repeated")
+    ap.add_argument("--sessions", help="Directory keeping logged-in sessions between runs",
+                    default=forum_archive.cache_path('forum_archive_sessions'))
+    ap.add_argument("--render-cache", help="Directory keeping converted chapters between runs",
+                    default=forum_archive.cache_path('thread_story_chapters'))
+    ap.add_argument("-p", "--processes", type=int, help="Number of processes converting chapters", default=None)
+    ap.add_argument("--metrics", help="Write a JSON summary of requests, pages and timings to this file", default=None)
     ap.add_argument("url", help="Post URL to contents page")
     g.add_argument("title", help="Story title in file", default=None, nargs='?')
     args = ap.parse_args()
@@ -175,7 +277,28 @@ def main():
         print("Error: must provide title", file=sys.stderr)
         sys.exit(1)
     if args.update:
-        args.title, args.url, cli = read_file(args.url)
+        args.title, args.url, args.contents = read_file(args.url)
+    forum_archive.ThreadGetter.max_workers = args.jobs
+    forum_archive.ThreadGetter.parse_processes = args.parse_processes
+    forum_archive.ThreadGetter.keep_orig = False # only processed text is used here
+    if args.offline and not args.cache:
+        print("Error: --offline requires --cache", file=sys.stderr)
+        sys.exit(1)
+    if args.cache:
+        forum_archive.cache = forum_archive.HTTPCache(args.cache, ttl=args.cache_ttl, offline=args.offline)
+    forum_archive.redirect_memo = forum_archive.RedirectMemo(args.links)
+    forum_archive.sessions = forum_archive.SessionStore(args.sessions)
+    forum_archive.parse_timezones(args.timezone)
+    if args.metrics:
+        metrics = forum_archive.Collector()
+        forum_archive.sinks.append(metrics)
+    try:
+        run(args)
+    finally:
+        if args.metrics:
+            metrics.dump(args.metrics)
+
+def run(args):
     if args.credential:
         c = args.credential.split(':', 1)
         c = {'username': c[0], 'password': c[1]}
@@ -192,13 +315,14 @@ def main():
         cl = [i for i in fp if i['post_url'] == args.url][0]
         author = cl['poster_name']
         l = list(make_listing(cl['text'], args.url))
+        forum_archive.redirect_memo.save()
 
         ede = os.environ.get('EDITOR', 'vim')
         helpstr = """Above the marker is the table of contents from the original file; below is 
 that derived from the source. Edit the former as desired, then quit. Everything
 below the marker will be ignored.
 """
-        ifstr = to_string(l) if not args.update else cli + '-' * 20 + "\n" + helpstr + to_string(l)
+        ifstr = to_string(l) if not args.update else args.contents + '-' * 20 + "\n" + helpstr + to_string(l)
         with tempfile.NamedTemporaryFile() as tf:
             tf.write(ifstr.encode())
             tf.flush()
@@ -211,13 +335,15 @@ below the marker will be ignored.
         l = to_chapters(ofstr)
         if not l:
             return
-        stext = download_story(l)
-        
+        stext = download_story(l, c)
+        forum_archive.redirect_memo.save()
+
     if args.author:
         author = args.author
     fn = make_filename(args.title) + '.html'
     with open(fn, 'w') as of:
-        compile_story((args.title, author, args.url), stext, l, of)
+        compile_story((args.title, author, args.url), stext, l, of,
+                      max_workers=args.processes, cache=RenderCache(args.render_cache))
 
 if __name__=="__main__":
     main()
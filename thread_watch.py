@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+# This program watches forum threads for new posts, cheaply enough to check
+# thousands at a time. For each thread on the watchlist it remembers only the
+# last page, the URL of the last post on it and the validators (ETag and
+# Last-Modified) the server gave for that page. A check is then a single
+# conditional request for the last page. It is answered with an empty 304 if
+# the server supports that and nothing has changed. Otherwise the page is
+# parsed to see whether posts or pages have been added.
+#
+# Changed threads are printed one URL per line, which is the format
+# batch_archive reads, or given to a command.
+
+import forum_archive, sys, time, argparse, subprocess
+import urllib.parse
+
+class Watchlist(forum_archive.JSONDict):
+    """A dictionary of thread URLs to what is known of them, kept in a JSON
+    file. Changes are written by save."""
+    indent = 1
+    def add(self, url):
+        self.setdefault(url, {'page': None, 'post': None, 'etag': None, 'modified': None,
+                              'checked': None, 'changed': None})
+
+class Watcher:
+    """Checks threads on a Watchlist. cred maps domains to the credentials
+    given to their getters; domains without any share a cookie jar."""
+    def __init__(self, watchlist, cred={}):
+        self.wl = watchlist
+        self.cred = forum_archive.domain_credentials(cred)
+    def check(self, url):
+        """Checks one thread, updating its entry. Returns True if posts or pages
+        have been added since the last check. The first check of a thread only
+        learns where it ends."""
+        w = self.wl[url]
+        g = forum_archive.make_getter(url, self.cred[urllib.parse.urlsplit(url).netloc])
+        purl = g.url if w['page'] is None else g.make_page_url(w['page'])
+        h = {}
+        if w['etag']:
+            h['If-None-Match'] = w['etag']
+        if w['modified']:
+            h['If-Modified-Since'] = w['modified']
+        with forum_archive.domain_slot(purl):
+            r = forum_archive.urlopen_retry(purl, opener=g.opener, headers=h)
+        w['checked'] = time.time()
+        if r.status == 304:
+            return False
+        html = r.read()
+        npages = g.get_npages(forum_archive.make_soup(html, g.npages_only))
+        if npages > (w['page'] or 1):
+            # The last page is elsewhere. It is got now, so that posts added to
+            # it before the next check are seen then.
+            purl = g.make_page_url(npages)
+            with forum_archive.domain_slot(purl):
+                r = forum_archive.urlopen_retry(purl, opener=g.opener)
+            html = r.read()
+        posts = g.get_posts(forum_archive.make_soup(html, g.posts_only), purl)
+        last = posts[-1]['post_url'] if posts else None
+        changed = w['page'] is not None and (npages > w['page'] or last != w['post'])
+        w.update(page=npages, post=last, etag=r.headers.get('ETag'), modified=r.headers.get('Last-Modified'))
+        if changed:
+            w['changed'] = w['checked']
+        return changed
+    def check_all(self, urls=None, max_workers=8):
+        """Checks the given threads, or all of them, yielding (url, changed) for
+        each in order. changed is None if the check failed; the error is
+        printed."""
+        def check(url):
+            try:
+                return self.check(url)
+            except Exception as e:
+                print("{}: {!r}".format(url, e), file=sys.stderr)
+                return None
+        urls = list(self.wl) if urls is None else urls
+        yield from zip(urls, forum_archive.ordered_map(check, urls, max_workers))
+
+def main():
+    ap = argparse.ArgumentParser(description="Watch forum threads for new posts")
+    ap.add_argument("watchlist", help="Watchlist file (JSON)")
+    ap.add_argument("-c", "--credential", action="append", default=[],
+                    help="Log in to a domain, given as domain=username:password; may be repeated")
+    ap.add_argument("--links", help="File remembering where links lead between runs",
+                    default=forum_archive.cache_path('thread_story_links.json'))
+    ap.add_argument("--timezone", action="append", default=[],
+                    help="Timezone of a forum's dates, given as host=zone, e.g. forums.spacebattles.com=America/New_York; may be repeated")
+    ap.add_argument("--sessions", help="Directory keeping logged-in sessions between runs",
+                    default=forum_archive.cache_path('forum_archive_sessions'))
+    sp = ap.add_subparsers(dest="cmd", required=True)
+    p = sp.add_parser("add", help="Add threads to the watchlist")
+    p.add_argument("urls", nargs='+')
+    p = sp.add_parser("remove", help="Remove threads from the watchlist")
+    p.add_argument("urls", nargs='+')
+    sp.add_parser("list", help="List watched threads")
+    p = sp.add_parser("check", help="Check threads for new posts, printing the URLs of those changed")
+    p.add_argument("urls", nargs='*', help="Threads to check; all if none are given")
+    p.add_argument("-j", "--jobs", type=int, help="Number of threads to check at once", default=8)
+    p.add_argument("-r", "--run", help="Command to run for each changed thread, with its URL as the last argument", default=None)
+    args = ap.parse_args()
+    wl = Watchlist(args.watchlist)
+    if args.cmd == "add":
+        for i in args.urls:
+            wl.add(i)
+    elif args.cmd == "remove":
+        for i in args.urls:
+            wl.pop(i, None)
+    elif args.cmd == "list":
+        for url, w in sorted(wl.items()):
+            print("{} page {} {}".format(url, w['page'], time.ctime(w['changed']) if w['changed'] else '-'))
+    elif args.cmd == "check":
+        cred = forum_archive.parse_credentials(args.credential)
+        forum_archive.redirect_memo = forum_archive.RedirectMemo(args.links)
+        forum_archive.sessions = forum_archive.SessionStore(args.sessions)
+        forum_archive.parse_timezones(args.timezone)
+        forum_archive.sinks[:] = [i for i in forum_archive.sinks if not isinstance(i, forum_archive.Progress)]
+        for i in args.urls:
+            wl.add(i)
+        failed = 0
+        try:
+            for url, changed in Watcher(wl, cred).check_all(args.urls or None, args.jobs):
+                failed += changed is None
+                if changed:
+                    print(url, flush=True)
+                    if args.run:
+                        subprocess.call(args.run.split() + [url])
+        finally:
+            wl.save()
+            forum_archive.redirect_memo.save()
+        if failed:
+            sys.exit(1)
+    if args.cmd in ("add", "remove"):
+        wl.save()
+
+if __name__=="__main__":
+    main()